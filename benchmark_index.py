@@ -0,0 +1,91 @@
+"""
+Memory and lookup benchmark of gitfs's PathIndex, against the nested dicts it replaced
+
+    python3 benchmark_index.py --entries 1000000 10000000
+
+Each measurement runs in its own process, so peak memory (ru_maxrss), taken before the paths to look up are
+generated, is that of one index only. For PathIndex, lookup is what getattr uses, get also makes a File view.
+"""
+import argparse
+import multiprocessing
+import random
+import resource
+import time
+
+from gitfs import PathIndex
+
+
+def make_paths(entries, files_per_dir=1000, dirs_per_dir=100):
+    for i in range(entries):
+        d = i // files_per_dir
+        yield f'dir{d // dirs_per_dir}/sub{d % dirs_per_dir}/file{i % files_per_dir}.dat'
+
+
+def nested_dict_get(tree, path):
+    for name in path.split('/'):
+        tree = tree.get(name, None)
+        if tree is None:
+            break
+    return tree
+
+
+def nested_dict_set(tree, path, value):
+    *dirs, name = path.split('/')
+    for d in dirs:
+        tree = tree.setdefault(d, {})
+    tree[name] = value
+
+
+def measure(kind, entries, lookups):
+    start = time.perf_counter()
+    if kind == 'PathIndex':
+        index = PathIndex()
+        for path in make_paths(entries):
+            index.add_file(path, 1024)
+        get = index.lookup
+        view = index.get
+    else:
+        index = {}
+        for path in make_paths(entries):
+            nested_dict_set(index, path, 1024)
+
+        def get(path):
+            return nested_dict_get(index, path)
+        view = None
+    build = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # KB on linux
+
+    rng = random.Random(0)
+    sample = [f'dir{rng.randrange(entries // 100000 + 1)}/sub{rng.randrange(100)}/file{rng.randrange(1000)}.dat'
+              for _ in range(lookups)]
+    start = time.perf_counter()
+    for path in sample:
+        get(path)
+    lookup = time.perf_counter() - start
+
+    get_view = None
+    if view is not None:
+        start = time.perf_counter()
+        for path in sample:
+            view(path)
+        get_view = (time.perf_counter() - start) / lookups * 1e9
+
+    return kind, entries, build, lookup / lookups * 1e9, get_view, peak / 1024
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--entries', type=int, nargs='+', default=[1000000, 10000000],
+                        help='index sizes to measure (default=1000000 10000000)')
+    parser.add_argument('--lookups', type=int, default=1000000,
+                        help='number of random lookups timed per index (default=1000000)')
+    args = parser.parse_args()
+
+    print(f'{"index":<12}{"entries":>12}{"build s":>10}{"lookup ns":>12}{"get ns":>10}{"peak MB":>10}')
+    ctx = multiprocessing.get_context('fork')
+    for entries in args.entries:
+        for kind in ('nested dict', 'PathIndex'):
+            with ctx.Pool(1, maxtasksperchild=1) as pool:
+                kind, entries, build, lookup, get_view, peak = pool.apply(measure, (kind, entries, args.lookups))
+            get_view = '-' if get_view is None else f'{get_view:.0f}'
+            print(f'{kind:<12}{entries:>12}{build:>10.1f}{lookup:>12.0f}{get_view:>10}{peak:>10.0f}')
@@ -1,4 +1,5 @@
 import os
+import re
 import sys
 import csv
 import logging
@@ -7,77 +8,320 @@ import subprocess
 import hashlib
 import time
 import threading
+import heapq
+import bisect
+import itertools
 from urllib.parse import urlparse
 from glob import glob
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import Future, CancelledError
+from concurrent.futures import TimeoutError as FuturesTimeoutError
 import argparse
 from collections import OrderedDict
 from collections import defaultdict
-from pathlib import Path
+from functools import lru_cache
+from array import array
 from fuse import FUSE, FuseOSError, Operations
-from errno import ENOENT
+from errno import ENOENT, EIO, ETIMEDOUT, ENOTEMPTY
 
 
 logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
 
 
-def getFromDict(dataDict, mapList):
+class Node:
     """
-    Retrieves value from nested dict (dir_structure) using a list of keys
+    A directory in PathIndex, with a dict of children by name: a Node for a directory, the row of the file in the
+    PathIndex's arrays for a file.
+    """
+    __slots__ = ('name', 'parent', 'children')
+
+    def __init__(self, name, parent, children=None):
+        self.name = name
+        self.parent = parent
+        self.children = {} if children is None else children
+
+    def is_dir(self):
+        return True
+
+    @property
+    def ino(self):
+        """
+        Inode number, unique among nodes in memory and kept while the node is, so also when it is moved
+        """
+        return id(self)
 
-    https://stackoverflow.com/questions/14692690/access-nested-dictionary-items-via-a-list-of-keys
+    def path(self):
+        names = []
+        node = self
+        while node.parent is not None:
+            names.append(node.name)
+            node = node.parent
+        return '/'.join(reversed(names))
+
+
+# inode numbers of files are their row plus this, above the addresses id() gives directories
+FILE_INO_BASE = 1 << 56
+
+
+class File:
+    """
+    A file in PathIndex, looked up by name in its directory. Files are not stored as objects, this is a view of the
+    file's row in the PathIndex's arrays: its size, and the mtime (in ns) and mode it was uploaded with, 0 when not
+    known. Views are made on lookup, and are only valid until the file is removed.
     """
+    __slots__ = ('index', 'name', 'parent', 'row')
+    children = None
+
+    def __init__(self, index, name, parent, row):
+        self.index = index
+        self.name = name
+        self.parent = parent
+        self.row = row
+
+    def is_dir(self):
+        return False
+
+    @property
+    def ino(self):
+        """
+        Inode number, kept while the file is, so also when it is moved
+        """
+        return FILE_INO_BASE + self.row
+
+    def path(self):
+        parent = self.parent.path()
+        return f'{parent}/{self.name}' if parent else self.name
+
+    @property
+    def path_hash(self):
+        """
+        Name of the file's branch
+        """
+        return branch_name(self.path())
+
+    @property
+    def size(self):
+        return self.index.sizes[self.row]
+
+    @size.setter
+    def size(self, size):
+        self.index.sizes[self.row] = size
+
+    @property
+    def mtime(self):
+        return self.index.mtimes[self.row]
+
+    @mtime.setter
+    def mtime(self, mtime):
+        self.index.mtimes[self.row] = mtime
 
-    for k in mapList:
-        dataDict = dataDict.get(k, None)
-        if dataDict is None:
-            break
-    return dataDict
+    @property
+    def mode(self):
+        return self.index.modes[self.row]
 
+    @mode.setter
+    def mode(self, mode):
+        self.index.modes[self.row] = mode
 
-def deleteFromDict(dataDict, mapList, delete_empty_recursive=False):
+
+class PathIndex:
     """
-    Deletes key from nested dict (dir_structure) using a list of keys, optionally deletes empty dicts as a result of deletion
+    Tree of the files on remote and of directories, looked up one path component at a time.
+
+    Paths are relative to the mountpoint, a leading slash is ignored. Name components are interned, so names shared
+    by many paths are stored once. Only directories are objects: a file is a row of the sizes, mtimes and modes
+    arrays, and its directory maps its name to the row, so a file costs a dict entry, an int and 20 bytes of arrays.
+    Every node has an inode number which it keeps until it is removed, also when it is moved, without storing one.
     """
 
-    _delfirst(dataDict, mapList)
-    if delete_empty_recursive:
-        for j in range(1, len(mapList)):
-            delete = _delsecond(dataDict, mapList, j)
-            if delete:
-                _delfirst(dataDict, mapList[:-j])
-            else:
-                break
-    return True
+    def __init__(self):
+        self.root = Node('', None)
+        self.files = 0
+        self.sizes = array('q')
+        self.mtimes = array('q')
+        self.modes = array('I')
+        self.free_rows = []  # rows of removed files, reused before the arrays grow
 
+    @staticmethod
+    def _names(path):
+        path = path.strip('/')
+        return path.split('/') if path else []
 
-def _delfirst(dataDict, mapList):
-    for k in mapList[:-1]:
-        dataDict = dataDict.get(k, None)
-    del dataDict[mapList[-1]]
+    def lookup(self, path):
+        """
+        Returns what is at path without making a view of it: its Node for a directory, its row for a file, None if
+        there is nothing. For hot paths such as getattr, see attrs.
+        """
+        path = path.strip('/')
+        if not path:
+            return self.root
+        node = self.root
+        for name in path.split('/'):
+            if type(node) is not Node:
+                return None
+            node = node.children.get(name, None)
+        return node
+
+    def attrs(self, node):
+        """
+        Returns (ino, mode, size, mtime) of what lookup returned, mode, size and mtime are 0 for directories
+        """
+        if type(node) is Node:
+            return id(node), 0, 0, 0
+        return FILE_INO_BASE + node, self.modes[node], self.sizes[node], self.mtimes[node]
+
+    def get(self, path):
+        names = path.strip('/').split('/')
+        name = names.pop()
+        node = self.root
+        for directory in names:
+            node = node.children.get(directory, None)
+            if type(node) is not Node:
+                return None
+        if not name:
+            return node
+        child = node.children.get(name, None)
+        if type(child) is int:
+            return File(self, name, node, child)
+        return child
+
+    def entries(self, node):
+        """
+        Returns (name, node) of the children of a directory
+        """
+        return [(name, child if isinstance(child, Node) else File(self, name, node, child))
+                for name, child in node.children.items()]
+
+    def _new_row(self, size, mtime, mode):
+        if self.free_rows:
+            row = self.free_rows.pop()
+            self.sizes[row], self.mtimes[row], self.modes[row] = size, mtime, mode
+            return row
+        self.sizes.append(size)
+        self.mtimes.append(mtime)
+        self.modes.append(mode)
+        return len(self.sizes) - 1
+
+    def _free(self, node):
+        """
+        Frees the rows of a removed file, or of every file below a removed directory. Returns how many it freed.
+        """
+        if not isinstance(node, Node):
+            self.free_rows.append(node.row)
+            return 1
+        rows = [file.row for _, file in self.walk_files(node)]
+        self.free_rows.extend(rows)
+        return len(rows)
+
+    def _makedirs(self, names):
+        node = self.root
+        for name in names:
+            child = node.children.get(name, None)
+            if not isinstance(child, Node):
+                if child is not None:
+                    self.free_rows.append(child)
+                    self.files -= 1
+                child = node.children[sys.intern(name)] = Node(sys.intern(name), node)
+            node = child
+        return node
+
+    def add_file(self, path, size, mtime=None, mode=None):
+        """
+        Adds a file or updates its size, and mtime and mode if given, creating its directories as needed
+        """
+        *dirs, name = self._names(path)
+        parent = self._makedirs(dirs)
+        row = parent.children.get(name, None)
+        if row is None or isinstance(row, Node):
+            if row is not None:
+                self.files -= self._free(row)
+            row = parent.children[sys.intern(name)] = self._new_row(size, mtime or 0, mode or 0)
+            self.files += 1
+        node = File(self, name, parent, row)
+        node.size = size
+        if mtime is not None:
+            node.mtime = mtime
+        if mode is not None:
+            node.mode = mode
+        return node
+
+    def add_dir(self, path):
+        return self._makedirs(self._names(path))
+
+    def _detach(self, node, prune_empty=False):
+        del node.parent.children[node.name]
+        if prune_empty:
+            parent = node.parent
+            while parent.parent is not None and not parent.children:
+                del parent.parent.children[parent.name]
+                parent = parent.parent
+
+    def remove(self, path, prune_empty=False):
+        """
+        Removes a file or directory, and with prune_empty the directories that became empty. Returns the removed
+        node, None if there was none.
+        """
+        node = self.get(path)
+        if node is None or node.parent is None:
+            return None
+        self._detach(node, prune_empty)
+        self.files -= self._free(node)
+        return node
 
+    def move(self, path_old, path_new, prune_empty=False):
+        """
+        Moves a file or directory, replacing whatever is at path_new. Returns the moved node, None if there was none.
+        """
+        node = self.get(path_old)
+        if node is None or node.parent is None or self._names(path_old) == self._names(path_new):
+            return node
+        self.remove(path_new)
+        self._detach(node, prune_empty)
+
+        *dirs, name = self._names(path_new)
+        parent = self._makedirs(dirs)
+        node.name = sys.intern(name)
+        node.parent = parent
+        parent.children[node.name] = node if isinstance(node, Node) else node.row
+        return node
+
+    def listdir(self, path):
+        node = self.get(path)
+        if node is None:
+            return None
+        return list(node.children) if isinstance(node, Node) else []
 
-def _delsecond(dataDict, mapList, j):
-    for k in mapList[:-j]:
-        dataDict = dataDict.get(k, None)
-    if len(dataDict) == 0:
-        return True
-    else:
-        return False
+    def walk_files(self, node=None):
+        """
+        Yields (path, node) of every file below node, or below the root
+        """
+        stack = [node or self.root]
+        while stack:
+            node = stack.pop()
+            base = node.path()
+            for name, child in list(node.children.items()):
+                if isinstance(child, Node):
+                    stack.append(child)
+                else:
+                    yield f'{base}/{name}' if base else name, File(self, name, node, child)
+
+    def __len__(self):
+        return self.files
 
 
-def nested_set(dic, keys, value):
+# branch names of recently used paths, open, read and release of a file all look its branch up
+@lru_cache(maxsize=65536)
+def branch_name(path):
     """
-    Sets key-value in nested dict (dir_structure) using a list of keys
+    Name of the branch a file is stored in
     """
-    for key in keys[:-1]:
-        dic = dic.setdefault(key, {})
-    dic[keys[-1]] = value
+    if path.startswith("/"):
+        path = path[1:]
+    return hashlib.sha1(bytes(path, 'utf-8')).hexdigest()[:-1]
 
 
 def split_path_all(path):
     """
-    Splits a filepath into a list of directories so it can be used to interact with dir_structure using nested dict functions
+    Splits a filepath into a list of directories
     """
     # this is here because get burnt by this too much, fusepy's path always start with / but we don't want it
     if path.startswith("/"):
@@ -100,46 +344,1108 @@ def split_path_all(path):
     return partial, folders
 
 
+def parse_filelist_row(row):
+    """
+    Parses a row of filelist.txt into (filepath, branchname, filesize, chunks, mtime, mode, bundle, member)
+
+    Rows written before chunked storage existed have no chunks column, those files are stored whole (chunks=0).
+    Rows written before metadata was recorded have no mtime (st_mtime_ns) and mode (st_mode) columns, both are 0.
+    Files packed into a bundle branch have its name and their blob hash (member) in the last two columns, files stored
+    in their own branch have neither.
+    """
+    filepath, branchname, filesize, *rest = row
+    chunks, mtime, mode = (list(map(int, rest[:3])) + [0, 0, 0])[:3]
+    bundle, member = (rest[3:] + ['', ''])[:2]
+    return filepath, branchname, int(filesize), chunks, mtime, mode, bundle, member
+
+
+def filelist_row(path, path_hash, filesize, chunks, mtime, mode, bundle='', member=''):
+    """
+    Row of filelist.txt for an entry, inverse of parse_filelist_row
+    """
+    row = [path, path_hash, filesize, chunks, mtime, mode]
+    if bundle:
+        row += [bundle, member]
+    return row
+
+
+def chunk_name(index):
+    """
+    Name of a chunk inside its file's branch. Independent of the filename so renamed branches stay readable.
+    """
+    return f'chunk{index:06d}'
+
+
+def count_chunks(filesize):
+    """
+    Number of chunks a file of this size is stored as, 0 if it is stored whole
+    """
+    if not chunk_size or filesize <= chunk_size * 1e6:
+        return 0
+    return -(-filesize // int(chunk_size * 1e6))
+
+
+def chunk_length(filesize, chunks):
+    """
+    Files are split into equal chunks (except the last), so chunk length can be derived from the index alone even if
+    --chunk-size changed since the file was uploaded.
+    """
+    return -(-filesize // chunks)
+
+
 class LRU(OrderedDict):
     """
     This keeps track of files on local filesystem and their sizes.
 
     Limit filesize, evicting the least recently looked-up key when full.
+
+    Eviction happens in a reclaimer thread: once the cache is over maxsize (the high watermark), it evicts keys in
+    batches until the cache is under the low watermark. Inserting only blocks while the cache is over the hard limit.
+
+    Dirty keys, written locally but not pushed yet, are never evicted. Neither are files at or below a pinned path,
+    as long as they fit in pin_size, they are not counted towards maxsize.
+
+    Replacement policy is in the _on_insert, _on_access, _on_resize, _on_remove and _victim hooks, subclasses override them to
+    implement other policies behind the same interface.
     """
 
-    def __init__(self, data_dir, maxsize=10, *args, **kwds):
+    def __init__(self, data_dir, maxsize=10, chunk_dir=None, low_watermark=0.9, hard_limit=1.2, trash_dir=None,
+                 pin_size=0, *args, **kwds):
         """
-        maxsize: GB
+        maxsize, pin_size: GB
+        low_watermark, hard_limit: fractions of maxsize
+        trash_dir: evicted files are moved here before they are deleted, so a file retrieved again under the same
+        name is never deleted by mistake. Has to be on the same filesystem as data_dir.
 
+        Keys are either filepaths relative to data_dir, or (path_hash, chunk index) tuples for chunks of chunked files
+        stored in chunk_dir.
         """
         self.maxsize = maxsize * 1e9
+        self.low_watermark = low_watermark * self.maxsize
+        self.hard_limit = hard_limit * self.maxsize
         self.filesize_counter = 0
+        self.pin_size = pin_size * 1e9
+        self.pins = set()  # paths whose files are kept
+        self.pinned_size = 0  # size of the files below pins
         self.data_dir = data_dir
+        self.chunk_dir = chunk_dir
+        self.trash_dir = trash_dir
+        self.trash_counter = itertools.count()
+        self.hits = 0
+        self.misses = 0
+        self.condition = threading.Condition(threading.RLock())
+        self.last_set = None  # never evicted, it is about to be opened
+        self.dirty = {}  # key -> version of its latest change that was not pushed yet
+        self.dirty_versions = itertools.count(1)
+        self.stalled = False  # nothing left that can be evicted
         super().__init__(*args, **kwds)
 
+        self.reclaimer = threading.Thread(
+            target=self._reclaim_loop, name='reclaimer', daemon=True)
+        self.reclaimer.start()
+
+    def key_path(self, key):
+        if isinstance(key, tuple):
+            path_hash, index = key
+            return os.path.join(self.chunk_dir, path_hash, str(index))
+        return os.path.join(self.data_dir, key)
+
     def __getitem__(self, key):
-        value = super().__getitem__(key)
-        self.move_to_end(key)
-        return value
+        with self.condition:
+            value = super().__getitem__(key)
+            self._on_access(key)
+            return value
 
     def __setitem__(self, key, value):
-        if key in self:
-            self.move_to_end(key)
-        super().__setitem__(key, value)
-        self.filesize_counter += value
-        while self.filesize_counter > self.maxsize:
-            if len(self) == 1:
-                break
-            oldest = next(iter(self))
-            self.filesize_counter -= self[oldest]
-            del self[oldest]
-
-            # delete from FS
-            os.remove(os.path.join(self.data_dir, oldest))
+        with self.condition:
+            pinned = self._under_pin(key)
+            if key in self:
+                old = super().__getitem__(key)
+                self.filesize_counter -= old
+                if pinned:
+                    self.pinned_size -= old
+                self._on_access(key)
+                self._on_resize(key, old, value)
+            else:
+                self._on_insert(key, value)
+            super().__setitem__(key, value)
+            self.filesize_counter += value
+            if pinned:
+                self.pinned_size += value
+            self.last_set = key
+            self.stalled = False
+
+            if self.usage() > self.maxsize:
+                self.condition.notify_all()
+            # only wait for the reclaimer if it is too far behind
+            while self.usage() > self.hard_limit and not self.stalled:
+                logging.debug('cache over hard limit, waiting for reclaimer')
+                self.condition.wait()
 
     def __delitem__(self, key):
-        self.filesize_counter -= self[key]
-        super().__delitem__(key)
+        with self.condition:
+            self.filesize_counter -= super().__getitem__(key)
+            if self._under_pin(key):
+                self.pinned_size -= super().__getitem__(key)
+            self._on_remove(key)
+            super().__delitem__(key)
+            self.dirty.pop(key, None)
+            self.stalled = False
+
+    def mark_dirty(self, key):
+        """
+        Pins key until mark_clean is called with the returned version
+        """
+        with self.condition:
+            if key not in self:
+                return None
+            self.dirty[key] = next(self.dirty_versions)
+            return self.dirty[key]
+
+    def mark_clean(self, key, version):
+        """
+        Unpins key, unless it was changed again after version was pushed
+        """
+        with self.condition:
+            if version is not None and self.dirty.get(key) == version:
+                del self.dirty[key]
+                self.stalled = False
+                self.condition.notify_all()
+
+    def _pinned(self, key):
+        return key == self.last_set or key in self.dirty or \
+            (self.pinned_size <= self.pin_size and self._under_pin(key))
+
+    def _under_pin(self, key):
+        if not self.pins or isinstance(key, tuple):
+            return False
+        path = key
+        while path:
+            if path in self.pins:
+                return True
+            path = os.path.dirname(path)
+        return False
+
+    def set_pins(self, pins):
+        """
+        Replaces the pinned paths, relative to data_dir
+        """
+        with self.condition:
+            self.pins = set(pin.strip('/') for pin in pins)
+            self.pinned_size = sum(size for key, size in OrderedDict.items(self) if self._under_pin(key))
+            self.stalled = False
+            self.condition.notify_all()
+
+    def usage(self):
+        """
+        Size counted towards maxsize, which is everything but pinned files that fit in pin_size
+        """
+        return self.filesize_counter - min(self.pinned_size, self.pin_size)
+
+    def save_manifest(self, path):
+        """
+        Writes entries, sizes and dirty flags in eviction order, so that load_manifest restores them on restart
+        """
+        rows = []
+        with self.condition:
+            for key in self._eviction_order():
+                dirty = int(key in self.dirty)
+                if isinstance(key, tuple):
+                    path_hash, index = key
+                    rows.append(['c', path_hash, index, self._size(key), dirty])
+                else:
+                    rows.append(['f', key, self._size(key), dirty])
+
+        with open(path + '.tmp', 'w') as csvfile:
+            csvwriter = csv.writer(
+                csvfile,
+                delimiter=' ',
+                quotechar='|',
+                quoting=csv.QUOTE_MINIMAL)
+            csvwriter.writerows(rows)
+        os.replace(path + '.tmp', path)
+
+    def load_manifest(self, path, keep):
+        """
+        Adds the entries of a manifest written by save_manifest, first to be evicted first. Clean entries are only
+        added if keep(key) is true, dirty ones always are.
+
+        Returns the dirty keys, or None if there is no manifest.
+        """
+        if not os.path.exists(path):
+            return None
+
+        dirty = []
+        with open(path, 'r') as csvfile:
+            for kind, *row in csv.reader(csvfile, delimiter=' ', quotechar='|'):
+                if kind == 'c':
+                    path_hash, index, size, is_dirty = row
+                    key = (path_hash, int(index))
+                else:
+                    key, size, is_dirty = row
+
+                if int(is_dirty):
+                    self[key] = int(size)
+                    self.mark_dirty(key)
+                    dirty.append(key)
+                elif keep(key):
+                    self[key] = int(size)
+        return dirty
+
+    def _reclaim_loop(self):
+        while True:
+            with self.condition:
+                while self.usage() <= self.maxsize or self.stalled:
+                    self.condition.wait()
+
+                evicted = []
+                while self.usage() > self.low_watermark and len(evicted) < RECLAIM_BATCH:
+                    victim = self._victim()
+                    if victim is None:
+                        self.stalled = True
+                        break
+                    victim_path = self.key_path(victim)
+                    del self[victim]
+                    evicted.append(self._to_trash(victim_path))
+                self.condition.notify_all()
+
+            # delete from FS, outside the lock
+            for victim_path in evicted:
+                try:
+                    os.remove(victim_path)
+                except FileNotFoundError:
+                    pass
+            logging.debug(f'evicted {len(evicted)} files, cache at {self.usage():.0f}')
+
+    def _to_trash(self, path):
+        if self.trash_dir is None:
+            return path
+        trash_path = os.path.join(self.trash_dir, str(next(self.trash_counter)))
+        try:
+            os.rename(path, trash_path)
+        except FileNotFoundError:
+            pass
+        return trash_path
+
+    def touch(self, key):
+        """
+        Records a cache hit on key
+        """
+        with self.condition:
+            self.hits += 1
+            if key in self:
+                self._on_access(key)
+
+    def record_miss(self, key):
+        self.misses += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0
+        return f'{self.__class__.__name__} hits {self.hits} misses {self.misses} hit rate {hit_rate:.1%} ' \
+            f'entries {len(self)} dirty {len(self.dirty)} size {self.usage():.0f}/{self.maxsize:.0f} ' \
+            f'pinned {self.pinned_size:.0f}/{self.pin_size:.0f}'
+
+    def _size(self, key):
+        return OrderedDict.__getitem__(self, key)
+
+    # Replacement policy
+    # ==================
+
+    def _on_insert(self, key, value):
+        # new keys go to the end of the OrderedDict, which is most recently used
+        pass
+
+    def _on_access(self, key):
+        self.move_to_end(key)
+
+    def _on_resize(self, key, old, new):
+        # called after _on_access when a key is set again, policies keeping size totals adjust them here
+        pass
+
+    def _on_remove(self, key):
+        pass
+
+    def _victim(self):
+        return next((key for key in self if not self._pinned(key)), None)
+
+    def _eviction_order(self):
+        return list(self)
+
+
+class TwoQueue(LRU):
+    """
+    2Q replacement: new keys enter a FIFO (a1in) and only keys referenced again while remembered get into the main LRU
+    (am). A scan fills and flushes a1in, but leaves am alone.
+
+    Keys evicted from a1in are remembered without their data in a1out, sized like the cache.
+    """
+
+    def __init__(self, *args, kin=0.25, **kwds):
+        # resident keys, their sizes are in the cache itself
+        self.a1in = OrderedDict()
+        self.am = OrderedDict()
+        self.a1in_size = 0
+        # forgotten keys -> size
+        self.a1out = OrderedDict()
+        self.a1out_size = 0
+        super().__init__(*args, **kwds)
+        self.kin = kin * self.maxsize
+
+    def _on_insert(self, key, value):
+        if key in self.a1out:
+            self.a1out_size -= self.a1out.pop(key)
+            self.am[key] = None
+        else:
+            self.a1in[key] = None
+            self.a1in_size += value
+
+    def _on_access(self, key):
+        if key in self.am:
+            self.am.move_to_end(key)
+        # hits in a1in are correlated references, they do not promote
+
+    def _on_resize(self, key, old, new):
+        if key in self.a1in:
+            self.a1in_size += new - old
+
+    def _on_remove(self, key):
+        if key in self.a1in:
+            self.a1in_size -= self._size(key)
+            del self.a1in[key]
+        self.am.pop(key, None)
+
+    def _eviction_order(self):
+        return [*self.a1in, *self.am]
+
+    def _victim(self):
+        a1in_victim = next((key for key in self.a1in if not self._pinned(key)), None)
+        am_victim = next((key for key in self.am if not self._pinned(key)), None)
+        if a1in_victim is not None and (self.a1in_size > self.kin or am_victim is None):
+            # remember it, a reference before it is forgotten promotes it to am
+            self.a1out[a1in_victim] = self._size(a1in_victim)
+            self.a1out_size += self._size(a1in_victim)
+            while self.a1out_size > self.maxsize:
+                _, size = self.a1out.popitem(last=False)
+                self.a1out_size -= size
+            return a1in_victim
+        return am_victim
+
+
+class ARC(LRU):
+    """
+    Adaptive replacement cache (Megiddo & Modha), weighted by file size.
+
+    t1 holds keys seen once recently, t2 keys seen at least twice. b1 and b2 remember keys evicted from them, and a hit
+    in either shifts the target size p of t1 towards the list that would have kept it.
+    """
+
+    def __init__(self, *args, **kwds):
+        # resident keys, their sizes are in the cache itself
+        self.t1 = OrderedDict()
+        self.t2 = OrderedDict()
+        self.t1_size = 0
+        # forgotten keys -> size
+        self.b1 = OrderedDict()
+        self.b2 = OrderedDict()
+        self.b1_size = 0
+        self.b2_size = 0
+        self.p = 0
+        super().__init__(*args, **kwds)
+
+    def _on_insert(self, key, value):
+        # ghosts of empty files have no size, their ratio counts as 1
+        if key in self.b1:
+            ratio = self.b2_size / self.b1_size if self.b1_size else 1
+            self.p = min(self.maxsize, self.p + max(ratio, 1) * value)
+            self.b1_size -= self.b1.pop(key)
+            self.t2[key] = None
+        elif key in self.b2:
+            ratio = self.b1_size / self.b2_size if self.b2_size else 1
+            self.p = max(0, self.p - max(ratio, 1) * value)
+            self.b2_size -= self.b2.pop(key)
+            self.t2[key] = None
+        else:
+            self.t1[key] = None
+            self.t1_size += value
+
+    def _on_access(self, key):
+        if key in self.t1:
+            self.t1_size -= self._size(key)
+            self.t2[key] = self.t1.pop(key)
+        elif key in self.t2:
+            self.t2.move_to_end(key)
+
+    def _on_resize(self, key, old, new):
+        if key in self.t1:
+            self.t1_size += new - old
+
+    def _on_remove(self, key):
+        if key in self.t1:
+            self.t1_size -= self._size(key)
+            del self.t1[key]
+        self.t2.pop(key, None)
+
+    def _eviction_order(self):
+        return [*self.t1, *self.t2]
+
+    def _victim(self):
+        if self.t1 and (self.t1_size > self.p or not self.t2):
+            candidates = [self.t1, self.t2]
+        else:
+            candidates = [self.t2, self.t1]
+
+        for lst in candidates:
+            for victim in lst:
+                if self._pinned(victim):
+                    continue
+                size = self._size(victim)
+                if lst is self.t1:
+                    self.b1[victim] = size
+                    self.b1_size += size
+                else:
+                    self.b2[victim] = size
+                    self.b2_size += size
+                # ghosts are limited to the size of the cache
+                while self.b1_size + self.b2_size > self.maxsize:
+                    if self.b1_size > self.b2_size:
+                        self.b1_size -= self.b1.popitem(last=False)[1]
+                    else:
+                        self.b2_size -= self.b2.popitem(last=False)[1]
+                return victim
+        return None
+
+
+class FrequencySketch:
+    """
+    Count-min sketch of how often keys were seen recently, with 4-bit counters that are halved periodically so old
+    popularity fades.
+    """
+
+    def __init__(self, width=65536, depth=4):
+        self.width = width
+        self.depth = depth
+        self.counters = bytearray(width * depth)
+        self.additions = 0
+        self.sample_size = 10 * width
+
+    def _indexes(self, key):
+        for row in range(self.depth):
+            yield row * self.width + hash((row, key)) % self.width
+
+    def increment(self, key):
+        for index in self._indexes(key):
+            if self.counters[index] < 15:
+                self.counters[index] += 1
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            self.counters = bytearray(c >> 1 for c in self.counters)
+            self.additions //= 2
+
+    def frequency(self, key):
+        return min(self.counters[index] for index in self._indexes(key))
+
+
+class TinyLFU(LRU):
+    """
+    W-TinyLFU: new keys enter a small LRU window, and a key leaving the window is only admitted to the main LRU if
+    it has been seen more often recently than the main LRU's victim. A scan passes through the window without
+    displacing frequently used files.
+    """
+
+    def __init__(self, *args, window=0.01, **kwds):
+        # resident keys, their sizes are in the cache itself
+        self.window = OrderedDict()
+        self.main = OrderedDict()
+        self.window_size = 0
+        self.sketch = FrequencySketch()
+        # set once the cache filled up, from then on keys only enter main through admission
+        self.full = False
+        super().__init__(*args, **kwds)
+        self.window_maxsize = window * self.maxsize
+
+    def _on_insert(self, key, value):
+        self.sketch.increment(key)
+        # the window overflows into main until the cache first fills up, the reclaimer only frees it down to the
+        # low watermark, so room left after that does not mean keys can skip admission
+        self.window[key] = None
+        self.window_size += value
+        while self.window_size > self.window_maxsize and len(self.window) > 1 and not self.full and \
+                self.usage() + value <= self.low_watermark:
+            candidate, _ = self.window.popitem(last=False)
+            self.main[candidate] = None
+            self.window_size -= self._size(candidate)
+
+    def _on_access(self, key):
+        self.sketch.increment(key)
+        if key in self.window:
+            self.window.move_to_end(key)
+        elif key in self.main:
+            self.main.move_to_end(key)
+
+    def _on_resize(self, key, old, new):
+        if key in self.window:
+            self.window_size += new - old
+
+    def _on_remove(self, key):
+        if key in self.window:
+            self.window_size -= self._size(key)
+            del self.window[key]
+        self.main.pop(key, None)
+        if not self.main:
+            self.full = False
+
+    def _eviction_order(self):
+        return [*self.window, *self.main]
+
+    def _victim(self):
+        self.full = True
+        candidate = next((k for k in self.window if not self._pinned(k)), None)
+        victim = next((k for k in self.main if not self._pinned(k)), None)
+
+        if candidate is None or victim is None:
+            return candidate if victim is None else victim
+
+        if self.window_size <= self.window_maxsize:
+            return victim
+
+        # admission: the window's oldest only gets into main if it is used more often than main's victim
+        if self.sketch.frequency(candidate) > self.sketch.frequency(victim):
+            self.main[candidate] = self.window.pop(candidate)
+            self.window_size -= self._size(candidate)
+            return victim
+        return candidate
+
+
+RECLAIM_BATCH = 64
+# files evicted per reclaimer lock hold
+
+CACHE_POLICIES = {
+    'lru': LRU,
+    '2q': TwoQueue,
+    'arc': ARC,
+    'tinylfu': TinyLFU,
+}
+
+
+MEMORY_ADMIT_READS = 8
+# reads of a file from disk before it is loaded into the memory tier
+
+
+class MemoryTier:
+    """
+    Contents of small files that are read often, kept in memory above the disk cache so reads of them need no
+    system calls.
+
+    Files of at most max_file_size bytes are loaded once they were read from disk MEMORY_ADMIT_READS times, and the
+    least recently read ones are dropped to stay within maxsize bytes. A file is dropped whenever it is written,
+    truncated, replaced or removed.
+    """
+
+    def __init__(self, maxsize, max_file_size):
+        self.maxsize = maxsize
+        self.max_file_size = max_file_size
+        self.files = OrderedDict()  # path -> memoryview of contents
+        self.size = 0
+        self.reads = defaultdict(int)  # path -> reads from disk, for admission
+        self.invalidations = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path):
+        with self.lock:
+            data = self.files.get(path, None)
+            if data is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.files.move_to_end(path)
+            return data
+
+    def read_from_disk(self, path, fh, size):
+        """
+        Records a read of path that missed, and loads it from fh once it was read often enough. size is its size on
+        disk, files being written or retrieved are not loaded.
+        """
+        if size is None or size > min(self.max_file_size, self.maxsize):
+            return
+        with self.lock:
+            if len(self.reads) > 10000:
+                # only recent reads count
+                self.reads.clear()
+            self.reads[path] += 1
+            if self.reads[path] < MEMORY_ADMIT_READS:
+                return
+            del self.reads[path]
+            invalidations = self.invalidations
+
+        data = memoryview(os.pread(fh, size + 1, 0))
+        if len(data) != size:
+            return
+
+        with self.lock:
+            if invalidations != self.invalidations or path in self.files:
+                # written while we were reading it
+                return
+            self.files[path] = data
+            self.size += size
+            while self.size > self.maxsize:
+                _, evicted = self.files.popitem(last=False)
+                self.size -= len(evicted)
+
+    def invalidate(self, path):
+        with self.lock:
+            self.invalidations += 1
+            self.reads.pop(path, None)
+            data = self.files.pop(path, None)
+            if data is not None:
+                self.size -= len(data)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0
+        return f'{self.__class__.__name__} hits {self.hits} misses {self.misses} hit rate {hit_rate:.1%} ' \
+            f'entries {len(self.files)} size {self.size:.0f}/{self.maxsize:.0f}'
+
+
+class StreamProgress:
+    """
+    Watermark of how much of a file being streamed in from remote has been written to disk.
+
+    Readers block in wait_for() only until the range they need has been written.
+    """
+
+    def __init__(self, size=None):
+        self.size = size
+        self.written = 0
+        self.done = False
+        self.error = None
+        self.condition = threading.Condition()
+
+    def set_size(self, size):
+        with self.condition:
+            self.size = size
+            self.condition.notify_all()
+
+    def advance(self, length):
+        with self.condition:
+            self.written += length
+            self.condition.notify_all()
+
+    def finish(self, error=None):
+        with self.condition:
+            self.done = True
+            self.error = error
+            self.condition.notify_all()
+
+    def wait_for(self, end=None, timeout=None):
+        """
+        Blocks until the first `end` bytes are on disk, or until the whole file is if end is None. Raises
+        FuturesTimeoutError if they are not after timeout seconds.
+        """
+        deadline = time.monotonic() + timeout if timeout else None
+        with self.condition:
+            while not self.done:
+                if end is not None and self.size is not None and self.written >= min(
+                        end, self.size):
+                    break
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    raise FuturesTimeoutError()
+                self.condition.wait(remaining)
+            if self.error is not None:
+                raise self.error
+
+
+class FileList:
+    """
+    Index of files on remote: path, filesize, number of chunks, mtime and mode, keyed by branch name (path hash).
+
+    On disk it is a snapshot (filelist.txt) plus an append-only journal (journal.txt) of changes made since, so each
+    change is a single append instead of a rewrite of the whole list. compact() folds the journal into the snapshot.
+    Both are synced through pure like filelist.txt always was.
+    """
+
+    def __init__(self, puredir):
+        self.snapshot_path = os.path.join(puredir, 'filelist.txt')
+        self.journal_path = os.path.join(puredir, 'journal.txt')
+        self.entries = {}  # path_hash -> (path, filesize, chunks, mtime, mode, bundle, member)
+        self.journal_length = 0
+        self.lock = threading.RLock()
+
+    def _read(self):
+        entries = {}
+        journal_length = 0
+
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, 'r') as csvfile:
+                for row in csv.reader(csvfile, delimiter=' ', quotechar='|'):
+                    filepath, branchname, *entry = parse_filelist_row(row)
+                    # older filelists have a row for every upload, last one wins
+                    entries[branchname] = (filepath, *entry)
+
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, 'r') as csvfile:
+                for op, *row in csv.reader(csvfile, delimiter=' ', quotechar='|'):
+                    journal_length += 1
+                    if op == '+':
+                        filepath, branchname, *entry = parse_filelist_row(row)
+                        entries[branchname] = (filepath, *entry)
+                    else:
+                        entries.pop(row[0], None)
+
+        return entries, journal_length
+
+    def load(self):
+        with self.lock:
+            self.entries, self.journal_length = self._read()
+        # journal is tracked in pure alongside filelist.txt, so it has to exist
+        open(self.journal_path, 'a').close()
+
+    def reload(self):
+        """
+        Reloads from disk after a pull, returns (changed, removed): entries that are new or differ, and those that are gone
+        """
+        with self.lock:
+            entries, self.journal_length = self._read()
+            changed = {k: v for k, v in entries.items() if self.entries.get(k) != v}
+            removed = {k: v for k, v in self.entries.items() if k not in entries}
+            self.entries = entries
+        return changed, removed
+
+    def _append(self, rows):
+        with open(self.journal_path, 'a') as csvfile:
+            csvwriter = csv.writer(
+                csvfile,
+                delimiter=' ',
+                quotechar='|',
+                quoting=csv.QUOTE_MINIMAL)
+            csvwriter.writerows(rows)
+        self.journal_length += len(rows)
+
+    def get(self, path_hash):
+        return self.entries.get(path_hash, None)
+
+    def items(self):
+        with self.lock:
+            return list(self.entries.items())
+
+    def put(self, path, path_hash, filesize, chunks, mtime=0, mode=0, bundle='', member=''):
+        self.apply([(path_hash, (path, filesize, chunks, mtime, mode, bundle, member))])
+
+    def remove(self, path_hash):
+        self.apply([(path_hash, None)])
+
+    def apply(self, changes):
+        """
+        Applies a list of (path_hash, (path, filesize, chunks, mtime, mode, bundle, member) or None to remove) at once, written as a single append
+        """
+        rows = []
+        with self.lock:
+            for path_hash, entry in changes:
+                if entry is None:
+                    self.entries.pop(path_hash, None)
+                    rows.append(['-', path_hash])
+                else:
+                    path, *metadata = entry
+                    self.entries[path_hash] = entry
+                    rows.append(['+'] + filelist_row(path, path_hash, *metadata))
+            self._append(rows)
+
+    def compact(self):
+        """
+        Writes the current entries as a new snapshot and empties the journal
+        """
+        with self.lock:
+            with open(self.snapshot_path + '.tmp', 'w') as csvfile:
+                csvwriter = csv.writer(
+                    csvfile,
+                    delimiter=' ',
+                    quotechar='|',
+                    quoting=csv.QUOTE_MINIMAL)
+                for path_hash, (path, *metadata) in self.entries.items():
+                    csvwriter.writerow(filelist_row(path, path_hash, *metadata))
+            os.replace(self.snapshot_path + '.tmp', self.snapshot_path)
+            open(self.journal_path, 'w').close()
+            self.journal_length = 0
+
+
+# number of journal rows after which the filelist is compacted on sync
+FILELIST_COMPACT_THRESHOLD = 10000
+
+
+class RetrievalCoordinator:
+    """
+    Single-flight retrievals: keeps one future per file (or chunk) being retrieved, so that everyone asking for it
+    while it is in flight waits on that future instead of retrieving it again.
+    """
+
+    def __init__(self):
+        self.futures = {}  # key -> [future, number of waiters]
+        self.lock = threading.RLock()
+
+    def start(self, key, submit):
+        """
+        Returns the future retrieving `key`, calling submit() to start the retrieval if none is in flight. Does not
+        wait for it, which is what prefetching wants.
+        """
+        with self.lock:
+            entry = self.futures.get(key, None)
+            if entry is None:
+                future = submit()
+                entry = self.futures[key] = [future, 0]
+                future.add_done_callback(lambda f: self._forget(key, f))
+            return entry[0]
+
+    def wait(self, key, submit, timeout=None):
+        """
+        Starts or joins the retrieval of `key` and waits for it. Timeouts, errors and cancellation are raised to
+        every waiter. A retrieval that has not started yet is cancelled once nobody is waiting for it anymore.
+        """
+        with self.lock:
+            future = self.start(key, submit)
+            entry = self.futures.get(key, None)
+            if entry is not None and entry[0] is future:
+                entry[1] += 1
+            else:
+                entry = None
+
+        try:
+            return future.result(timeout)
+        finally:
+            if entry is not None:
+                with self.lock:
+                    entry[1] -= 1
+                    if entry[1] == 0 and not future.done():
+                        future.cancel()
+
+    def in_flight(self, key):
+        with self.lock:
+            return key in self.futures
+
+    def _forget(self, key, future):
+        with self.lock:
+            entry = self.futures.get(key, None)
+            if entry is not None and entry[0] is future:
+                del self.futures[key]
+
+
+def copy_future(source, target):
+    """
+    Resolves target, a running future, the way source was resolved
+    """
+    if source.cancelled():
+        target.set_exception(CancelledError())
+    elif source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
+
+
+# Priority classes for git operations, lower runs first
+PRIORITY_RETRIEVE = 0  # blocking retrievals issued by open()
+PRIORITY_MODIFY = 1  # renames and removals
+PRIORITY_PREFETCH = 2  # retrievals of files likely to be opened next
+PRIORITY_COMMIT = 3  # background uploads
+
+
+# files opened one after another in name order before a directory is treated as being scanned
+SEQUENTIAL_RUN = 3
+
+
+class Prefetcher:
+    """
+    Detects sequential scans of a directory from the order its files are opened in, and starts retrieving the
+    `count` files that come next in name order before they are opened.
+
+    Files that were prefetched but not opened yet take at most `max_bytes` of the cache, and at most `max_batches`
+    prefetches are in flight at once, each a single batched retrieval.
+    """
+
+    def __init__(self, count, max_bytes, max_batches):
+        self.count = count
+        self.max_bytes = max_bytes
+        self.max_batches = max_batches
+        self.lock = threading.Lock()
+        # directory -> [file names in order, number of entries they were listed from, index of last file opened,
+        #               length of the run of files opened in order, index of last file prefetched]
+        self.dirs = {}
+        self.unused = {}  # path -> size, prefetched and not opened yet
+        self.batches = 0
+        self.prefetched = 0
+        self.used = 0
+        self.wasted = 0
+
+    def opened(self, partial, start):
+        """
+        Records that partial was opened, and calls start(paths), which returns a future, to prefetch the files after
+        it once its directory is being scanned
+        """
+        if not self.count:
+            return
+
+        directory, name = os.path.split(partial)
+        with self.lock:
+            if self.unused.pop(partial, None) is not None:
+                self.used += 1
+
+            node = path_index.get(directory)
+            if node is None or not node.is_dir():
+                return
+            state = self.dirs.get(directory, None)
+            if state is None or state[1] != len(node.children):
+                names = sorted(name for name, child in path_index.entries(node) if not child.is_dir())
+                state = self.dirs[directory] = [names, len(node.children), -1, 0, -1]
+            names = state[0]
+
+            index = bisect.bisect_left(names, name)
+            if index == len(names) or names[index] != name:
+                return
+            # skipping a file still counts as in order
+            state[3] = state[3] + 1 if 0 < index - state[2] <= 2 else 1
+            state[2] = index
+            if state[3] < SEQUENTIAL_RUN or self.batches >= self.max_batches:
+                return
+
+            self._forget_evicted()
+            budget = self.max_bytes - sum(self.unused.values())
+            paths = []
+            for next_index in range(max(index, state[4]) + 1, min(index + 1 + self.count, len(names))):
+                path = os.path.join(directory, names[next_index])
+                node = path_index.get(path)
+                if node is not None and path not in chunk_counts and lru_file_cache.get(path, None) is None \
+                        and not retrieval.in_flight(path):
+                    if node.size > budget:
+                        break
+                    budget -= node.size
+                    paths.append((path, node.size))
+                state[4] = next_index
+            if not paths:
+                return
+
+            self.batches += 1
+            self.unused.update(paths)
+            self.prefetched += len(paths)
+
+        logging.debug(f'prefetching {len(paths)} files after {partial}')
+        start([path for path, _ in paths]).add_done_callback(self._batch_done)
+
+    def _forget_evicted(self):
+        for path in list(self.unused):
+            if lru_file_cache.get(path, None) is None and not retrieval.in_flight(path):
+                del self.unused[path]
+                self.wasted += 1
+
+    def _batch_done(self, future):
+        with self.lock:
+            self.batches -= 1
+
+    def stats(self):
+        with self.lock:
+            return {'prefetched': self.prefetched, 'used': self.used, 'wasted': self.wasted,
+                    'use_rate': round(self.used / self.prefetched, 3) if self.prefetched else 0.0}
+
+
+class PriorityExecutor:
+    """
+    Runs git operations on a fixed pool of threads, always picking the most urgent job first.
+
+    Jobs run by priority class, and in submission order within a class. The first `reserved_workers` threads only
+    take retrievals, so an open() never queues behind a backlog of uploads.
+    """
+
+    def __init__(self, max_workers, reserved_workers=1,
+                 thread_name_prefix='fsworker'):
+        # always leave at least one worker for the other priority classes
+        reserved_workers = max(0, min(reserved_workers, max_workers - 1))
+
+        self._queue = []  # heap of (priority, sequence, future, fn, args, kwargs, exclusive)
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._shutdown = False
+        self._running = 0
+        self._exclusive = False
+        self._threads = []
+
+        for i in range(max_workers):
+            t = threading.Thread(
+                target=self._worker,
+                args=(i < reserved_workers,),
+                name=f'{thread_name_prefix}_{i}',
+                daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, fn, *args, priority=PRIORITY_COMMIT, exclusive=False,
+               **kwargs):
+        """
+        Exclusive jobs wait for running jobs to finish, and no other job starts until they are done.
+        """
+        future = Future()
+        with self._condition:
+            if self._shutdown:
+                raise RuntimeError('cannot submit after shutdown')
+            heapq.heappush(
+                self._queue,
+                (priority, next(self._sequence), future, fn, args, kwargs, exclusive))
+            self._condition.notify_all()
+        return future
+
+    def qsize(self, priority=None):
+        with self._condition:
+            if priority is None:
+                return len(self._queue)
+            return sum(1 for job in self._queue if job[0] == priority)
+
+    def shutdown(self, wait=True):
+        """
+        Stops accepting jobs, workers exit once the queue is drained
+        """
+        with self._condition:
+            self._shutdown = True
+            self._condition.notify_all()
+        if wait:
+            for t in self._threads:
+                t.join()
+
+    def _next_job(self, reserved):
+        with self._condition:
+            while True:
+                if self._queue and not self._exclusive and (
+                        not reserved or self._queue[0][0] == PRIORITY_RETRIEVE):
+                    job = heapq.heappop(self._queue)
+                    if job[6]:
+                        self._exclusive = True
+                        while self._running:
+                            self._condition.wait()
+                    self._running += 1
+                    return job
+                if self._shutdown and (reserved or not self._queue):
+                    return None
+                self._condition.wait()
+
+    def _worker(self, reserved):
+        while True:
+            job = self._next_job(reserved)
+            if job is None:
+                return
+            _, _, future, fn, args, kwargs, exclusive = job
+
+            if future.set_running_or_notify_cancel():
+                try:
+                    result = fn(*args, **kwargs)
+                except BaseException as e:
+                    logging.exception(f'git operation {fn.__name__} failed')
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+
+            with self._condition:
+                self._running -= 1
+                if exclusive:
+                    self._exclusive = False
+                self._condition.notify_all()
 
 
 #####################
@@ -150,176 +1456,928 @@ class LRU(OrderedDict):
 
 
 def git_remove_from_remote(gitfs_dir, path_hash):
+    global stale_members
 
     dirtydir = pre_git_ops(gitfs_dir)
 
-    filelist_path = os.path.join(gitfs_dir, 'pure', 'filelist.txt')
-
-    output = subprocess.run(
-        f'git push origin --delete {path_hash}',
-        cwd=dirtydir,
-        capture_output=True,
-        shell=True)
-    logging.debug(output)
+    entry = filelist.get(path_hash)
+    if entry is not None and entry[5]:
+        # packed files stay in their bundle until it is repacked
+        stale_members += 1
+    else:
+        output = subprocess.run(
+            f'git push origin --delete {path_hash}',
+            cwd=dirtydir,
+            capture_output=True,
+            shell=True)
+        logging.debug(output)
 
-    # remove from pure/filelist
-    output = subprocess.run(
-        f" sed -i '/{path_hash}/d' {filelist_path}",
-        capture_output=True,
-        shell=True)  # assume hash don't collide, or we got bigger problems
-    logging.debug(output)
+    filelist.remove(path_hash)
 
     post_git_ops(gitfs_dir)
 
     return True
 
 
-def git_rename_branch(gitfs_dir, path_old, path_new,
-                      destination_file_exists, remove_from_remote_func):
+# branches moved by one fetch and push, keeps the command under the kernel's limit for a single argument
+RENAME_BATCH = 500
+
+
+def git_rename_branches(gitfs_dir, moves):
     """
-    We want to ensure that destination file is removed before renaming, so we block on that here.
+    Moves the branches of files renamed from path_old to path_new, given as a list of (path_old, path_new). A branch
+    already at path_new is replaced.
+
+    Only commits and trees are fetched (--filter=blob:none), and as the commits are on remote already, pushing them
+    under their new names sends no file data. Every batch of branches is moved by a single atomic push, which only
+    replaces a branch at path_new if it is still at the tip listed before. Files packed into a bundle keep their
+    member, only their filelist entry moves.
+    See https://stackoverflow.com/a/21302474
     """
+    global stale_members
 
     dirtydir = pre_git_ops(gitfs_dir)
-    filelist_path = os.path.join(gitfs_dir, 'pure', 'filelist.txt')
 
-    path_hash_old = hashlib.sha1(bytes(path_old, 'utf-8')).hexdigest()[:-1]
-    path_hash_new = hashlib.sha1(bytes(path_new, 'utf-8')).hexdigest()[:-1]
+    renames = []
+    for path_old, path_new in moves:
+        path_hash_old = hashlib.sha1(bytes(path_old, 'utf-8')).hexdigest()[:-1]
+        path_hash_new = hashlib.sha1(bytes(path_new, 'utf-8')).hexdigest()[:-1]
+        # files that were never pushed have no branch, they are uploaded under their new name instead
+        if filelist.get(path_hash_old) is not None:
+            renames.append((path_new, path_hash_old, path_hash_new))
+
+    for start in range(0, len(renames), RENAME_BATCH):
+        batch = renames[start:start + RENAME_BATCH]
+        # entries are (path, filesize, chunks, mtime, mode, bundle, member)
+        branches = [old for _, old, _ in batch if not filelist.get(old)[5]]
+
+        tips = {}
+        if branches:
+            output = subprocess.run(
+                f'git fetch --depth=1 --filter=blob:none origin {" ".join(branches)}',
+                cwd=dirtydir,
+                capture_output=True,
+                shell=True)
+            logging.debug(output)
+            if output.returncode != 0:
+                raise RuntimeError(f'fetch of {len(branches)} branches to rename failed: {output.stderr}')
+
+            tips = read_fetch_head(dirtydir)
+
+        # branches being replaced, only if nobody pushed to them since
+        destinations = [new for _, old, new in batch if not filelist.get(old)[5]]
+        replaced_tips = {}
+        if destinations:
+            output = subprocess.run(
+                f'git ls-remote --heads origin {" ".join(destinations)}',
+                cwd=dirtydir,
+                capture_output=True,
+                shell=True)
+            logging.debug(output)
+            if output.returncode != 0:
+                raise RuntimeError(f'listing {len(destinations)} branches to rename to failed: {output.stderr}')
+            for line in output.stdout.decode('utf-8').splitlines():
+                commit, ref = line.split('\t')
+                replaced_tips[ref[len('refs/heads/'):]] = commit
+
+        refspecs = []
+        leases = []
+        changes = []
+        replaced_members = 0
+        for path_new, path_hash_old, path_hash_new in batch:
+            entry = filelist.get(path_hash_old)
+            replaced = filelist.get(path_hash_new)
+            if replaced is not None and replaced[5]:
+                replaced_members += 1
+            if not entry[5]:
+                refspecs.append(f'{tips[path_hash_old]}:refs/heads/{path_hash_new}')
+                refspecs.append(f':refs/heads/{path_hash_old}')
+                leases.append(f'--force-with-lease=refs/heads/{path_hash_new}:{replaced_tips.get(path_hash_new, "")}')
+            elif replaced is not None and not replaced[5]:
+                # a packed file replaces one with its own branch
+                refspecs.append(f':refs/heads/{path_hash_new}')
+            changes.append((path_hash_old, None))
+            changes.append((path_hash_new, (path_new, *entry[1:])))
+
+        if refspecs:
+            output = subprocess.run(
+                f'git push --atomic {" ".join(leases)} origin {" ".join(refspecs)}',
+                cwd=dirtydir,
+                capture_output=True,
+                shell=True)
+            logging.debug(output)
+            if output.returncode != 0:
+                raise RuntimeError(f'push of {len(batch)} renamed branches failed: {output.stderr}')
+
+        filelist.apply(changes)
+        stale_members += replaced_members
+
+    logging.info(f'renamed {len(renames)} files')
 
-    if destination_file_exists:
-        # have to delete destination file if it exists, or same path+filename
-        # will clash
-        remove_from_remote_func(path_old, block=True)
+    post_git_ops(gitfs_dir)
+
+    return True
 
-    # Rename git branch remotely to save on 2-way file transfer, unfortunately still have to fetch it first.
-    # See https://stackoverflow.com/a/21302474
+
+def git_object_hash(output, step):
+    """
+    Returns the object hash printed by a plumbing command. Raises if the command failed, as an empty hash would turn
+    the refspec pushing it into one deleting the branch.
+    """
+    object_hash = output.stdout.strip().decode('utf-8')
+    if output.returncode != 0 or not re.fullmatch('[0-9a-f]{40}', object_hash):
+        raise RuntimeError(f'{step} failed: {output.stderr}')
+    return object_hash
+
+
+def git_hash_file(dirtydir, full_path):
+    """
+    Writes a file into the object store as a blob, returns its hash
+    """
     output = subprocess.run(
-        f'git fetch origin {path_hash_old}',
+        'git hash-object -w --stdin-paths',
         cwd=dirtydir,
+        input=bytes(full_path, 'utf-8'),
         capture_output=True,
         shell=True)
-    logging.debug(output)
+    return git_object_hash(output, f'hash-object of {full_path}')
 
+
+def git_make_commit(dirtydir, entries, parent=None, missing=False):
+    """
+    Builds a commit of a tree with the given (name, blob hash) entries, returns its hash.
+
+    With missing, the blobs do not have to be in the object store, for trees of members of a bundle fetched without
+    its blobs, which are on remote already.
+    """
+    tree_input = b''.join(
+        b'100644 blob ' + bytes(blob, 'utf-8') + b'\t' + bytes(name, 'utf-8') + b'\0' for name, blob in entries)
+    missing_arg = ' --missing' if missing else ''
     output = subprocess.run(
-        f'git push origin origin/{path_hash_old}:refs/heads/{path_hash_new} :{path_hash_old}',
+        f'git mktree -z{missing_arg}',
         cwd=dirtydir,
+        input=tree_input,
         capture_output=True,
         shell=True)
-    logging.debug(output)
+    tree = git_object_hash(output, 'mktree')
 
-    # edit pure/filelist
-    # remove then add
+    parent_arg = f' -p {parent}' if parent else ''
     output = subprocess.run(
-        f" sed -i -e '/{path_hash_old}/{{w /dev/stdout' -e 'd}}' {filelist_path}",
+        f"git commit-tree {tree}{parent_arg} -m 'a'",
+        cwd=dirtydir,
         capture_output=True,
-        shell=True)  # assume hash don't collide, or we got bigger problems
+        shell=True)
     logging.debug(output)
 
-    # filepath might contain space, but path_hash and filesize has no space,
-    # so we can safely assume last split is filesize
-    filesize = output.stdout.strip().decode('utf-8').split(' ')[-1]
+    return git_object_hash(output, 'commit-tree')
 
-#     logging.debug(filesize)
 
-    with open(filelist_path, 'a') as csvfile:
-        csvwriter = csv.writer(
-            csvfile,
-            delimiter=' ',
-            quotechar='|',
-            quoting=csv.QUOTE_MINIMAL)
-        csvwriter.writerow([path_new, path_hash_new, filesize])
+def git_build_commit(dirtydir, full_path, filename, filesize, chunks,
+                     parent=None):
+    """
+    Writes the file (or its chunks) straight into the object store and builds a commit for it with plumbing commands,
+    no working tree or copy of the file involved. Returns the commit hash.
+    """
 
-    post_git_ops(gitfs_dir)
+    if chunks:
+        # large files are stored as fixed-size chunks, so reads can fetch only the parts they need
+        length = chunk_length(filesize, chunks)
+        entries = []
+        with open(full_path, 'rb') as f:
+            for index in range(chunks):
+                output = subprocess.run(
+                    'git hash-object -w --stdin',
+                    cwd=dirtydir,
+                    input=f.read(length),
+                    capture_output=True,
+                    shell=True)
+                entries.append((chunk_name(index), git_object_hash(output, f'hash-object of chunk {index}')))
+    else:
+        # file is stored at the root of its branch, because it makes renaming
+        # branch possible without deletebranch/makebranch
+        entries = [(filename, git_hash_file(dirtydir, full_path))]
+    logging.debug(entries)
+
+    return git_make_commit(dirtydir, entries, parent)
+
+
+def bundle_name(path_hash):
+    """
+    Bundle branch a small file is packed into, one of 256 picked by the first two digits of its path hash
+    """
+    return 'bundle_' + path_hash[:2]
+
+
+def git_commit_to_remote(gitfs_dir, batch):
+    """
+    Uploads a batch of files, a list of (path, path_hash, full_path, filename), with a single push for all of them.
+
+    Files up to pack_size KB are packed into a bundle branch, shared with other small files, as a member named by its
+    blob hash. The push is atomic, and the filelist is updated for the whole batch at once once it succeeded.
+    """
+    global stale_members
+
+    dirtydir = pre_git_ops(gitfs_dir)
+    start = time.monotonic()
+
+    files = []
+    for path, path_hash, full_path, filename in batch:
+        try:
+            stat = os.stat(full_path)
+        except FileNotFoundError:
+            logging.debug(f'{path} was removed before upload')
+            continue
+        packed = pack_size and stat.st_size <= pack_size * 1e3 and not count_chunks(stat.st_size)
+        bundle = bundle_name(path_hash) if packed else ''
+        files.append((path, path_hash, full_path, filename, stat, bundle))
+
+    bundles = set(bundle for *_, bundle in files if bundle)
+    # bundles are always built on their tip, to keep their other members
+    wanted = list(bundles)
+    if keep_history:
+        wanted += [path_hash for _, path_hash, *_, bundle in files if not bundle]
+    # else every upload replaces the branch with a single parentless commit
+
+    parents = {}
+    if wanted:
+        # find which branches exist already, so we can commit on top of them
+        output = subprocess.run(
+            ['git', 'ls-remote', '--heads', 'origin', *wanted],
+            cwd=dirtydir,
+            capture_output=True)
+        logging.debug(output)
+        if output.returncode != 0:
+            raise RuntimeError(f'listing branches to upload to failed: {output.stderr}')
+        for line in output.stdout.decode('utf-8').splitlines():
+            commit, ref = line.split('\t')
+            parents[ref[len('refs/heads/'):]] = commit
+
+        if parents:
+            # only their tip commits are needed, not their content
+            output = subprocess.run(
+                ['git', 'fetch', '--depth=1', '--filter=blob:none', 'origin', *parents],
+                cwd=dirtydir,
+                capture_output=True)
+            logging.debug(output)
+            if output.returncode != 0:
+                raise RuntimeError(f'fetch of {len(parents)} branches to upload to failed: {output.stderr}')
+
+    refspecs = []
+    leases = []
+    changes = []
+    members = defaultdict(set)
+    replaced_members = 0
+    total_size = 0
+    force = '' if keep_history else '+'
+
+    for path, path_hash, full_path, filename, stat, bundle in files:
+        filesize = stat.st_size
+        previous = filelist.get(path_hash)
+        if previous is not None and previous[5]:
+            # its previous version stays in its bundle until it is repacked
+            replaced_members += 1
+
+        if bundle:
+            blob = git_hash_file(dirtydir, full_path)
+            members[bundle].add(blob)
+            if previous is not None and not previous[5]:
+                # it grew small enough to be packed, its own branch goes
+                refspecs.append(f':refs/heads/{path_hash}')
+            changes.append((path_hash, (path, filesize, 0, stat.st_mtime_ns, stat.st_mode, bundle, blob)))
+        else:
+            chunks = count_chunks(filesize)
+            commit = git_build_commit(
+                dirtydir, full_path, filename, filesize, chunks, parents.get(path_hash, None))
+            refspecs.append(f'{force}{commit}:refs/heads/{path_hash}')
+            changes.append((path_hash, (path, filesize, chunks, stat.st_mtime_ns, stat.st_mode, '', '')))
+        total_size += filesize
+
+    for bundle, blobs in members.items():
+        parent = parents.get(bundle, None)
+        entries = {}
+        if parent is not None:
+            entries = worker_cat_file(dirtydir).tree_entries(parent + '^{tree}')
+        entries.update((blob, blob) for blob in blobs)
+        # its other members were fetched without their blobs
+        commit = git_make_commit(dirtydir, entries.items(), parent if keep_history else None, missing=True)
+        refspecs.append(f'{commit}:refs/heads/{bundle}')
+        # other uploads may be adding to the same bundle, only replace the tip we built on
+        leases.append(f'--force-with-lease=refs/heads/{bundle}:{parent or ""}')
+
+    if refspecs:
+        output = subprocess.run(
+            ['git', 'push', '--atomic', *leases, 'origin', *refspecs],
+            cwd=dirtydir,
+            capture_output=True)
+        logging.debug(output)
+        if output.returncode != 0:
+            raise RuntimeError(f'push of {len(refspecs)} files failed: {output.stderr}')
+
+    # finally update filelist
+    filelist.apply(changes)
+    stale_members += replaced_members
+
+    for path_hash, (path, filesize, chunks, mtime, mode, *_) in changes:
+        # record what was uploaded, for getattr once the file is evicted
+        node = path_index.get(path)
+        if node is not None and not node.is_dir():
+            node.mtime, node.mode = mtime, mode
+        if chunks:
+            chunk_counts[path] = chunks
+        else:
+            chunk_counts.pop(path, None)
+
+    packed = f' ({sum(len(blobs) for blobs in members.values())} into {len(members)} bundles)' if members else ''
+    logging.info(
+        f'uploaded batch of {len(changes)} files{packed}, {total_size} bytes in {time.monotonic() - start:.2f}s')
+
+    post_git_ops(gitfs_dir, added_bytes=total_size)
 
     return True
 
 
-def git_commit_to_remote(gitfs_dir, path_hash, full_path, filename, path):
+# fraction of a bundle's members that may be no longer referenced before it is repacked
+REPACK_GARBAGE = 0.25
+
+
+def git_repack_bundles(gitfs_dir):
+    """
+    Rewrites bundles of which more than REPACK_GARBAGE of the members are no longer referenced by the filelist, as a
+    single parentless commit of the referenced members, and deletes bundles left without any.
+
+    Runs exclusively, so no upload adds a member between reading the filelist and pushing. The count of stale
+    members is only reset once the push succeeded, so a failed repack is tried again.
+    """
+    global stale_members
 
     dirtydir = pre_git_ops(gitfs_dir)
-    filelist_path = os.path.join(gitfs_dir, 'pure', 'filelist.txt')
-    dirty_filepath = os.path.join(dirtydir, filename)
 
-    # pull first in case it exists
-    # if new file, will error, but doesn't matter
+    live = defaultdict(set)
+    for _, (path, filesize, chunks, mtime, mode, bundle, member) in filelist.items():
+        if bundle:
+            live[bundle].add(member)
+
     output = subprocess.run(
-        f'git pull origin {path_hash}',
+        "git ls-remote --heads origin 'bundle_*'",
         cwd=dirtydir,
         capture_output=True,
         shell=True)
     logging.debug(output)
+    if output.returncode != 0:
+        raise RuntimeError(f'listing bundles to repack failed: {output.stderr}')
+    tips = {}
+    for line in output.stdout.decode('utf-8').splitlines():
+        commit, ref = line.split('\t')
+        tips[ref[len('refs/heads/'):]] = commit
+    if not tips:
+        stale_members = 0
+        return True
 
     output = subprocess.run(
-        f'git checkout -b {path_hash}',
+        f'git fetch --depth=1 --filter=blob:none origin {" ".join(tips)}',
         cwd=dirtydir,
         capture_output=True,
         shell=True)
-    # don't think there is a way to replace without fetching, unless we look for and delete entire branch
-    # if we don't care about history, can just blast away remote branch using
-    # git ls-remote --heads origin path_hash - if output != None, blast it away
-
     logging.debug(output)
+    if output.returncode != 0:
+        raise RuntimeError(f'fetch of {len(tips)} bundles to repack failed: {output.stderr}')
+
+    cat_file = worker_cat_file(dirtydir)
+    refspecs = []
+    leases = []
+    for bundle, tip in tips.items():
+        entries = cat_file.tree_entries(tip + '^{tree}')
+        kept = [(name, blob) for name, blob in entries.items() if name in live[bundle]]
+        if len(entries) - len(kept) <= REPACK_GARBAGE * len(entries):
+            continue
+        if kept:
+            refspecs.append(f'{git_make_commit(dirtydir, kept, missing=True)}:refs/heads/{bundle}')
+        else:
+            refspecs.append(f':refs/heads/{bundle}')
+        leases.append(f'--force-with-lease=refs/heads/{bundle}:{tip}')
 
-    # then transfer file
-    # now we only transfer the file to base dir, because it will make renaming
-    # branch possible without deletebranch/makebranch
-    shutil.copy(full_path, dirty_filepath)
+    if refspecs:
+        output = subprocess.run(
+            f'git push --atomic {" ".join(leases)} origin {" ".join(refspecs)}',
+            cwd=dirtydir,
+            capture_output=True,
+            shell=True)
+        logging.debug(output)
+        if output.returncode != 0:
+            raise RuntimeError(f'push of {len(refspecs)} repacked bundles failed: {output.stderr}')
 
-    # add + commit + push
-    output = subprocess.run(
-        f"git add {dirty_filepath} && git commit -m 'a' && git push -u origin {path_hash}",
-        cwd=dirtydir,
-        capture_output=True,
-        shell=True)
-    logging.debug(output)
+    stale_members = 0
+    logging.info(f'repacked {len(refspecs)} of {len(tips)} bundles')
+
+    post_git_ops(gitfs_dir)
+
+    return True
+
+
+# seconds before a file whose upload failed on its own is retried, doubled after every further failure
+UPLOAD_RETRY_DELAY = 10
+# failed uploads of a file on its own before it is quarantined
+UPLOAD_ATTEMPTS = 6
+# files uploaded by one push, keeps the push's refspecs under the kernel's limit for a command line
+UPLOAD_BATCH = 500
+
+
+class CommitBatcher:
+    """
+    Write-behind queue of files to upload, so that many small uploads share one push.
+
+    A batch is handed to the executor as a single git_commit_to_remote job once `window` seconds have passed since
+    its first file was added, or once its files add up to `max_bytes`.
+
+    Each path is either pending, running, or both: saving a pending file again only replaces its pending upload, and
+    a file saved while its upload is running stays pending until that upload is done, so uploads of the same path
+    never run at once and only the latest content is pushed.
+
+    Files stay dirty in lru_file_cache until their upload succeeds. The files of a failed batch are retried one by one,
+    so a file that can't be pushed does not hold back the others, and a file failing on its own is retried with
+    backoff. After UPLOAD_ATTEMPTS it is quarantined: it stays dirty but is not retried until it is saved again or
+    gitfs is restarted. Writers are throttled while more than `max_dirty_bytes` are queued, so they can't get ahead of
+    uploads.
+    """
+
+    def __init__(self, gitfs_dir, window=2, max_bytes=100 * 1e6, max_dirty_bytes=0):
+        self.gitfs_dir = gitfs_dir
+        self.window = window
+        self.max_bytes = max_bytes
+        self.max_dirty_bytes = max_dirty_bytes
+        self.pending = OrderedDict()  # path -> ((path, path_hash, full_path, filename), size)
+        self.running = {}  # path -> size, of batches that were handed to the executor and are not done yet
+        self.dirty_size = 0  # bytes in pending and running
+        self.alone = set()  # paths that failed in a batch, uploaded in a batch of their own
+        self.failures = {}  # path -> number of failed uploads on its own
+        self.retry_at = {}  # path -> time.monotonic() before which it is not retried
+        self.quarantined = set()
+        self.held = {}  # path -> number of renames onto it in flight, it is not uploaded before they are done
+        self.waiting = []  # (paths, callback) of renames and deletes waiting for uploads of paths to be done
+        self.first_added = None
+        self.draining = False
+        self.condition = threading.Condition()
+
+        self.thread = threading.Thread(
+            target=self._loop, name='batcher', daemon=True)
+        self.thread.start()
+
+    def add(self, path, path_hash, full_path, filename):
+        try:
+            size = os.stat(full_path).st_size
+        except FileNotFoundError:
+            size = 0
+
+        with self.condition:
+            if path in self.pending:
+                logging.debug(f'replacing pending upload of {path}')
+                self.dirty_size -= self.pending[path][1]
+            elif not self._flushable():
+                self.first_added = time.monotonic()
+            self.pending[path] = ((path, path_hash, full_path, filename), size)
+            self.dirty_size += size
+            # new content gets a fresh start
+            self._forget_failures(path)
+            self.condition.notify_all()
+
+    def discard(self, path):
+        with self.condition:
+            item = self.pending.pop(path, None)
+            if item is not None:
+                self.dirty_size -= item[1]
+            self._forget_failures(path)
+            self.condition.notify_all()
+
+    def hold(self, paths):
+        """
+        Keeps uploads of paths back until unhold(), so a rename onto them can't replace what they upload
+        """
+        with self.condition:
+            for path in paths:
+                self.held[path] = self.held.get(path, 0) + 1
+
+    def unhold(self, paths):
+        with self.condition:
+            for path in paths:
+                self.held[path] -= 1
+                if not self.held[path]:
+                    del self.held[path]
+            self.condition.notify_all()
+
+    def after_uploads(self, paths, callback):
+        """
+        Calls callback() once no upload of paths is running, right away if none is. A rename or delete of a file
+        waits for its upload, which would otherwise add the file back to the filelist after it.
+        """
+        with self.condition:
+            running = set(path for path in paths if path in self.running)
+            if running:
+                self.waiting.append((running, callback))
+                return
+        callback()
+
+    def _forget_failures(self, path):
+        self.alone.discard(path)
+        self.failures.pop(path, None)
+        self.retry_at.pop(path, None)
+        self.quarantined.discard(path)
+
+    def _flushable(self):
+        now = time.monotonic()
+        return [path for path in self.pending
+                if path not in self.running and path not in self.held and
+                (self.draining or self.retry_at.get(path, 0) <= now)]
+
+    def _next_retry(self):
+        """
+        Seconds until the next file waiting for a retry can be uploaded, None if there is none
+        """
+        waiting = [self.retry_at[path] for path in self.pending if path in self.retry_at and path not in self.running]
+        return max(0, min(waiting) - time.monotonic()) if waiting else None
+
+    def _pending_bytes(self):
+        return sum(size for path, (_, size) in self.pending.items()
+                   if path not in self.running)
+
+    def throttle(self):
+        """
+        Blocks while more than max_dirty_bytes wait to be uploaded
+        """
+        if not self.max_dirty_bytes or self.dirty_size <= self.max_dirty_bytes:
+            return
+        with self.condition:
+            while self.dirty_size > self.max_dirty_bytes:
+                logging.debug(f'throttling writes, {self.dirty_size} bytes waiting to be uploaded')
+                self.flush()
+                self.condition.wait()
+
+    def flush(self):
+        with self.condition:
+            paths = self._flushable()
+            if not paths:
+                return
+            batches = [[path] for path in paths if path in self.alone]
+            together = [path for path in paths if path not in self.alone]
+            batches += [together[start:start + UPLOAD_BATCH] for start in range(0, len(together), UPLOAD_BATCH)]
+            batches = [(batch, [self.pending.pop(path) for path in batch]) for batch in batches]
+            for batch, items in batches:
+                self.running.update((path, size) for path, (_, size) in zip(batch, items))
+            logging.debug(f'flushing {len(paths)} files in {len(batches)} batches')
+            # files still waiting for their running upload start a new window
+            self.first_added = time.monotonic() if self._flushable() else None
+
+        for batch, items in batches:
+            # anything written after this is still dirty once the batch is pushed
+            versions = [lru_file_cache.dirty.get(path) for path in batch]
+
+            future = executor.submit(
+                git_commit_to_remote,
+                self.gitfs_dir,
+                [item for item, _ in items],
+                priority=PRIORITY_COMMIT)
+            future.add_done_callback(lambda f, items=items, versions=versions: self._done(f, items, versions))
+
+    def _done(self, future, items, versions):
+        failed = future.cancelled() or future.exception() is not None
+        with self.condition:
+            for (item, size), version in zip(items, versions):
+                path = item[0]
+                del self.running[path]
+                self.dirty_size -= size
+                if not failed:
+                    lru_file_cache.mark_clean(path, version)
+                    self._forget_failures(path)
+                elif not self.draining and path not in self.pending and lru_file_cache.dirty.get(path) is not None:
+                    # retry, unless it was saved again or deleted meanwhile
+                    if len(items) > 1:
+                        # find out which files of the batch fail
+                        self.alone.add(path)
+                    else:
+                        self.failures[path] = self.failures.get(path, 0) + 1
+                        if self.failures[path] >= UPLOAD_ATTEMPTS:
+                            logging.error(f'uploading {path} failed {self.failures[path]} times, not retrying it '
+                                          f'until it is saved again')
+                            self.quarantined.add(path)
+                            continue
+                        self.retry_at[path] = time.monotonic() + UPLOAD_RETRY_DELAY * 2 ** (self.failures[path] - 1)
+                    self.pending[path] = (item, size)
+                    self.dirty_size += size
+            if failed:
+                logging.error(f'uploading batch of {len(items)} files failed')
+            if self._flushable() and self.first_added is None:
+                self.first_added = time.monotonic()
+            for running, _ in self.waiting:
+                running.difference_update(item[0] for item, _ in items)
+            ready = [callback for running, callback in self.waiting if not running]
+            self.waiting = [(running, callback) for running, callback in self.waiting if running]
+            self.condition.notify_all()
+
+        for callback in ready:
+            callback()
+
+    def drain(self):
+        """
+        Uploads everything pending, and waits until all uploads are done. Failed uploads are not retried.
+        """
+        with self.condition:
+            self.draining = True
+            while self.pending or self.running:
+                self.flush()
+                self.condition.wait()
+
+    def _loop(self):
+        while True:
+            with self.condition:
+                while not self._flushable():
+                    # woken by add(), or once the next failed upload is due for a retry
+                    self.condition.wait(self._next_retry())
+                if self.first_added is None:
+                    # a retry that became due
+                    self.first_added = time.monotonic()
+                while self._flushable() and self._pending_bytes() < self.max_bytes:
+                    remaining = self.first_added + self.window - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+            self.flush()
+
+
+class CatFileBatch:
+    """
+    Wraps a `git cat-file --batch` process, which streams objects to us without a working tree checkout
+    """
+
+    def __init__(self, cwd):
+        self.cwd = cwd
+        self.process = subprocess.Popen(
+            ['git', 'cat-file', '--batch'],
+            cwd=cwd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE)
+
+    def _request(self, rev):
+        self.process.stdin.write(bytes(rev, 'utf-8') + b'\n')
+        self.process.stdin.flush()
+
+        header = self.process.stdout.readline()
+        if not header:
+            self._broken(rev)
+        if header.endswith(b' missing\n'):
+            raise FileNotFoundError(f'{rev} not found')
+        return int(header.split()[2])
+
+    def _broken(self, rev):
+        """
+        The process died or closed its output in the middle of an object. Kills it, so that worker_cat_file starts
+        a new one, and raises.
+        """
+        self.process.kill()
+        self.process.wait()
+        raise RuntimeError(f'cat-file stopped while reading {rev}')
+
+    def read(self, rev):
+        size = self._request(rev)
+        data = self.process.stdout.read(size)
+        # object content is followed by a newline
+        if len(data) != size or self.process.stdout.read(1) != b'\n':
+            self._broken(rev)
+        return data
+
+    def stream(self, rev, f, progress=None, block_size=1024 * 1024):
+        """
+        Writes object `rev` to file object f block by block, advancing progress as it goes. Returns object size.
+        """
+        size = self._request(rev)
+
+        remaining = size
+        while remaining:
+            block = self.process.stdout.read(min(block_size, remaining))
+            if not block:
+                self._broken(rev)
+            f.write(block)
+            remaining -= len(block)
+            if progress is not None:
+                progress.advance(len(block))
+
+        # object content is followed by a newline
+        if self.process.stdout.read(1) != b'\n':
+            self._broken(rev)
+
+        return size
+
+    def tree_entries(self, rev):
+        """
+        Returns {name: blob hash} of the tree `rev`
+        """
+        data = self.read(rev)
+        entries = {}
+        while data:
+            header, _, data = data.partition(b'\0')
+            _, name = header.split(b' ', 1)
+            entries[name.decode('utf-8')] = data[:20].hex()
+            data = data[20:]
+        return entries
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+
+worker_state = threading.local()
+
+
+def worker_cat_file(dirtydir):
+    """
+    Returns the long-lived cat-file process of the current worker thread, starting it if needed
+    """
+    cat_file = getattr(worker_state, 'cat_file', None)
+    if cat_file is None or cat_file.cwd != dirtydir or not cat_file.alive() or \
+            worker_state.generation != object_store_generation:
+        if cat_file is not None:
+            cat_file.close()
+        cat_file = worker_state.cat_file = CatFileBatch(dirtydir)
+        # dirty directories are recreated when the object store is reclaimed
+        worker_state.generation = object_store_generation
+    return cat_file
 
-    # finally update pure/filelist.txt
-    with open(filelist_path, 'a') as csvfile:
-        csvwriter = csv.writer(
-            csvfile,
-            delimiter=' ',
-            quotechar='|',
-            quoting=csv.QUOTE_MINIMAL)
-        csvwriter.writerow([path, path_hash, os.stat(full_path).st_size])
 
-    # clean up dirty
+def close_worker_cat_file():
+    cat_file = getattr(worker_state, 'cat_file', None)
+    if cat_file is not None:
+        cat_file.close()
+        worker_state.cat_file = None
+
+
+def read_fetch_head(dirtydir):
+    """
+    Returns {branch: commit} of the branches fetched by the last fetch
+    """
+    tips = {}
+    # lines of FETCH_HEAD are: <commit>\t<not-for-merge or empty>\tbranch '<name>' of <remote>
+    with open(os.path.join(dirtydir, '.git', 'FETCH_HEAD'), 'r') as f:
+        for line in f:
+            commit, _, description = line.split('\t')
+            tips[description.split("'")[1]] = commit
+    return tips
+
+
+def file_blobs(cat_file, commit, path_file, chunks=0):
+    """
+    Returns the blobs a file stored in its own branch is made of, in order, from the tree of its commit
+    """
+    entries = cat_file.tree_entries(commit + '^{tree}')
+    if chunks:
+        return [entries[chunk_name(index)] for index in range(chunks)]
+    elif path_file in entries or len(entries) != 1:
+        return [entries[path_file]]
+    else:
+        # branch was renamed, its only entry still has the old filename
+        return list(entries.values())
+
+
+def git_fetch_tip(dirtydir, path_hash, blobless=False):
+    """
+    Fetches only the latest commit of a file's branch, and returns its hash.
+
+    If blobless, only commit and tree are fetched. The fetch registers origin as a promisor remote, so that reading a
+    blob afterwards lazily fetches just that blob.
+    """
+
+    filter_arg = '--filter=blob:none' if blobless else '--no-filter'
     output = subprocess.run(
-        f'git checkout master',
+        f'git fetch --depth=1 {filter_arg} origin {path_hash}',
         cwd=dirtydir,
         capture_output=True,
         shell=True)
+    logging.debug(output)
 
-    post_git_ops(gitfs_dir)
+    if output.returncode != 0:
+        raise FileNotFoundError(f'branch {path_hash} not found on remote')
 
-    return True
+    with open(os.path.join(dirtydir, '.git', 'FETCH_HEAD'), 'r') as f:
+        return f.readline().split('\t')[0]
 
 
-def git_retrieve_from_remote(gitfs_dir, path_hash, path_file, full_path):
+def git_retrieve_from_remote(gitfs_dir, path_hash, path_file, full_path,
+                             chunks=0, progress=None):
     """
     Retrieve is safe for multiple threads to simultaneously use. But we will still use individual dirty directory so we can track
     and clean up filesize.
+
+    Blobs are streamed straight into full_path by the worker's cat-file process, chunked files are reassembled there.
+    If progress is given, it is advanced as data is written, so that reads can be served while we are still writing.
+    """
+
+    dirtydir = pre_git_ops(gitfs_dir)
+
+    try:
+        entry = filelist.get(path_hash)
+        if entry is not None and entry[5]:
+            # packed into a bundle, only its own member is fetched
+            git_fetch_tip(dirtydir, entry[5], blobless=True)
+            cat_file = worker_cat_file(dirtydir)
+            blobs = [entry[6]]
+        else:
+            commit = git_fetch_tip(dirtydir, path_hash)
+
+            cat_file = worker_cat_file(dirtydir)
+            blobs = file_blobs(cat_file, commit, path_file, chunks)
+
+        # unbuffered, so readers of full_path see every block as soon as it is written
+        filesize = 0
+        with open(full_path, 'wb', buffering=0) as f:
+            for blob in blobs:
+                filesize += cat_file.stream(blob, f, progress)
+    except Exception as e:
+        if progress is not None:
+            progress.finish(e)
+        raise
+
+    if progress is not None:
+        progress.finish()
+
+    post_git_ops(gitfs_dir, added_bytes=filesize)
+
+    return True
+
+
+def git_retrieve_batch_from_remote(gitfs_dir, items):
+    """
+    Retrieves several files with a single fetch, for prefetching and hydrating. items are (path_hash, path_file, chunks,
+    full_path, progress, future), the future of each file is resolved as soon as it is written. Files whose future
+    was cancelled before the batch started are skipped.
+    """
+
+    dirtydir = pre_git_ops(gitfs_dir)
+
+    items = [item for item in items if item[5].set_running_or_notify_cancel()]
+    entries = {path_hash: filelist.get(path_hash) for path_hash, *_ in items}
+    branches = [path_hash for path_hash, entry in entries.items() if entry is None or not entry[5]]
+    bundles = set(entry[5] for entry in entries.values() if entry is not None and entry[5])
+
+    tips = {}
+    for names, filter_arg in ((branches, '--no-filter'), (bundles, '--filter=blob:none')):
+        if not names:
+            continue
+        output = subprocess.run(
+            f'git fetch --depth=1 {filter_arg} origin {" ".join(names)}',
+            cwd=dirtydir,
+            capture_output=True,
+            shell=True)
+        logging.debug(output)
+        if output.returncode == 0:
+            tips.update(read_fetch_head(dirtydir))
+        # else one of them is gone, the others are fetched one by one below
+
+    cat_file = worker_cat_file(dirtydir)
+    total_size = 0
+    for path_hash, path_file, chunks, full_path, progress, future in items:
+        try:
+            entry = entries[path_hash]
+            if entry is not None and entry[5]:
+                if entry[5] not in tips:
+                    git_fetch_tip(dirtydir, entry[5], blobless=True)
+                blobs = [entry[6]]
+            else:
+                commit = tips.get(path_hash, None) or git_fetch_tip(dirtydir, path_hash)
+                blobs = file_blobs(cat_file, commit, path_file, chunks)
+
+            with open(full_path, 'wb', buffering=0) as f:
+                for blob in blobs:
+                    total_size += cat_file.stream(blob, f, progress)
+        except Exception as e:
+            logging.exception(f'prefetching {full_path} failed')
+            progress.finish(e)
+            future.set_exception(e)
+        else:
+            progress.finish()
+            future.set_result(True)
+
+    post_git_ops(gitfs_dir, added_bytes=total_size)
+
+    return True
+
+
+def git_retrieve_chunk_from_remote(gitfs_dir, path_hash, index, chunk_path):
+    """
+    Retrieves a single chunk of a chunked file, without fetching the other chunks.
     """
 
     dirtydir = pre_git_ops(gitfs_dir)
 
-    # i assume is in master branch
-    output = subprocess.run(
-        f'git fetch origin {path_hash}:{path_hash}',
-        cwd=dirtydir,
-        capture_output=True,
-        shell=True)
-    logging.debug(output)
+    commit = git_fetch_tip(dirtydir, path_hash, blobless=True)
 
-    output = subprocess.run(
-        f'git checkout {path_hash} -- {path_file}',
-        cwd=dirtydir,
-        capture_output=True,
-        shell=True)
-    logging.debug(output)
+    cat_file = worker_cat_file(dirtydir)
+    blob = cat_file.tree_entries(commit + '^{tree}')[chunk_name(index)]
 
-    shutil.move(os.path.join(dirtydir, path_file), full_path)
+    os.makedirs(os.path.dirname(chunk_path), exist_ok=True)
+    with open(chunk_path, 'wb') as f:
+        size = cat_file.stream(blob, f)
 
-    post_git_ops(gitfs_dir)
+    post_git_ops(gitfs_dir, added_bytes=size)
 
     return True
 
@@ -327,6 +2385,9 @@ def git_retrieve_from_remote(gitfs_dir, path_hash, path_file, full_path):
 def pre_git_ops(gitfs_dir):
     """
     Directs thread to correct dirtydirectory to work from, and creates it if missing
+
+    Dirty directories are small repositories whose .git/objects links to the object store shared by all workers, so
+    creating one copies nothing.
     """
 
     dirtydir = os.path.join(
@@ -334,38 +2395,75 @@ def pre_git_ops(gitfs_dir):
         'dirty_' +
         threading.current_thread().name)
     puredir = os.path.join(gitfs_dir, 'pure')
+    objectsdir = os.path.join(gitfs_dir, 'objects')
 
     # if dir not there, make it
     if not os.path.exists(dirtydir):
-        shutil.copytree(puredir, dirtydir)
+        os.makedirs(os.path.join(objectsdir, 'info'), exist_ok=True)
+        os.makedirs(os.path.join(objectsdir, 'pack'), exist_ok=True)
+
+        output = subprocess.run(
+            ['git', 'init', '-q', dirtydir],
+            capture_output=True)
+        logging.debug(output)
+
+        shutil.rmtree(os.path.join(dirtydir, '.git', 'objects'))
+        os.symlink(objectsdir, os.path.join(dirtydir, '.git', 'objects'))
+
+        # same remote as pure, and no automatic gc, objects are reclaimed by git_reclaim_object_store instead.
+        # origin is a promisor remote from the start, as the first blobless fetch would make it: a worker's cat-file
+        # process reads the config once, and could not lazily fetch blobs if it started before that fetch
+        shutil.copy(
+            os.path.join(puredir, '.git', 'config'),
+            os.path.join(dirtydir, '.git', 'config'))
+        with open(os.path.join(dirtydir, '.git', 'config'), 'a') as f:
+            f.write('[gc]\n\tauto = 0\n')
+            f.write('[core]\n\trepositoryformatversion = 1\n')
+            f.write('[remote "origin"]\n\tpromisor = true\n\tpartialclonefilter = blob:none\n')
 
     return dirtydir
 
 
-def post_git_ops(gitfs_dir):
+def post_git_ops(gitfs_dir, added_bytes=0):
     """
-    If queue empty, checks if filesize of directory is too large, and remakes directory if so.
+    Accounts for objects added to the shared object store, and schedules a reclaim if it grew too large.
     """
-    # if dir_size > 0.1% of cache size and queue is empty
-    # wipe and remake
+    global object_store_bytes, object_store_reclaiming
 
-    dirtydir = os.path.join(
+    with object_store_lock:
+        object_store_bytes += added_bytes
+        if object_store_bytes <= cache_size * 1e9 or object_store_reclaiming:
+            return True
+        object_store_reclaiming = True
+
+    logging.debug(f'Reclaiming object store, size {object_store_bytes}')
+    executor.submit(
+        git_reclaim_object_store,
         gitfs_dir,
-        'dirty_' +
-        threading.current_thread().name)
-    puredir = os.path.join(gitfs_dir, 'pure')
+        priority=PRIORITY_COMMIT,
+        exclusive=True)
+
+    return True
+
+
+def git_reclaim_object_store(gitfs_dir):
+    """
+    Wipes the shared object store and the dirty directories whose refs point into it, they are recreated on demand.
 
-    # https://stackoverflow.com/a/1392549
-    if executor._work_queue.qsize() < max_workers:
-        dir_size = sum(f.stat().st_size for f in Path(
-            dirtydir).glob('/.git/objects/**/*') if f.is_file())
-        if dir_size > cache_size * 1e9:
-            # only check .git/objects to reduce number of dirs to check
+    Runs exclusively, so no other git operation is using them. Everything in there is either on remote already, or
+    was retrieved into datadir.
+    """
+    global object_store_bytes, object_store_generation, object_store_reclaiming
 
-            logging.debug(f'Remaking {dirtydir}, size {dir_size}')
+    close_worker_cat_file()
+    for dirtydir in glob(os.path.join(gitfs_dir, 'dirty_*')):
+        shutil.rmtree(dirtydir)
+    shutil.rmtree(os.path.join(gitfs_dir, 'objects'), ignore_errors=True)
 
-            shutil.rmtree(dirtydir)
-            shutil.copytree(puredir, dirtydir)
+    with object_store_lock:
+        object_store_bytes = 0
+        object_store_generation += 1
+        object_store_reclaiming = False
 
     return True
 
@@ -373,58 +2471,82 @@ def post_git_ops(gitfs_dir):
 def git_sync_filelist(gitfs_dir):
     global remote_file_size
     """
-    Pull changes, merge and push changes for pure/filelist.txt
+    Pull changes, merge and push changes for pure/filelist.txt and pure/journal.txt
 
-    Only handles merge conflicts by accepting both modifications, so only additions + additions can work.
+    Only handles merge conflicts by accepting both modifications, so only additions + additions can work. The filelist
+    is locked only while it is committed, merged and reloaded, not during the fetch.
 
     """
 
     puredir = os.path.join(gitfs_dir, 'pure')
-    filelist_path = os.path.join(puredir, 'filelist.txt')
 
-    # if we want multi-client, maybe filelist.txt should be a list of actions.
-    # can just prune after a while
-    output = subprocess.run(
-        f'git commit -a -m "update filelist"',
-        cwd=puredir,
-        capture_output=True,
-        shell=True)
-    logging.debug(output)
+    # fetch first, uploads finishing meanwhile can still append to the filelist
     output = subprocess.run(
-        f'git pull origin master',
+        f'git fetch origin master',
         cwd=puredir,
         capture_output=True,
         shell=True)
     logging.debug(output)
 
-    if b"Merge conflict" in output.stdout:
+    # hold the filelist so no change is appended while git rewrites it
+    with filelist.lock:
+        if filelist.journal_length > FILELIST_COMPACT_THRESHOLD:
+            filelist.compact()
+
         output = subprocess.run(
-            f" sed -i -e '/^<<<<<<</d' -e '/^=======/d' -e '/^>>>>>>>/d' {filelist_path}",
+            f'git add filelist.txt journal.txt && git commit -m "update filelist"',
+            cwd=puredir,
+            capture_output=True,
+            shell=True)
+        logging.debug(output)
+        output = subprocess.run(
+            f'git merge --no-edit FETCH_HEAD',
+            cwd=puredir,
             capture_output=True,
             shell=True)
         logging.debug(output)
 
-        # update dir_structure
-        with open(os.path.join(puredir, 'filelist.txt'), 'r') as csvfile:
-            f = csv.reader(csvfile, delimiter=' ', quotechar='|')
-            for filepath, branchname, filesize in f:
-                partial, all_paths = split_path_all(filepath)
-
-                if getFromDict(dir_structure, all_paths) != int(filesize):
+        if b"Merge conflict" in output.stdout:
+            for path in (filelist.snapshot_path, filelist.journal_path):
+                output = subprocess.run(
+                    f" sed -i -e '/^<<<<<<</d' -e '/^=======/d' -e '/^>>>>>>>/d' {path}",
+                    capture_output=True,
+                    shell=True)
+                logging.debug(output)
+
+        if b"Already up" not in output.stdout:
+            # update path_index with what changed remotely
+            changed, removed = filelist.reload()
+
+            for branchname, (filepath, filesize, *_) in removed.items():
+                partial, _ = split_path_all(filepath)
+                invalidate_cached_file(gitfs_dir, partial, branchname)
+                path_index.remove(partial)
+                chunk_counts.pop(partial, None)
+                remote_file_size -= filesize
+
+            for branchname, (filepath, filesize, chunks, mtime, mode, *_) in changed.items():
+                partial, _ = split_path_all(filepath)
+
+                node = path_index.get(partial)
+                if node is None or node.size != filesize or (mtime and node.mtime != mtime):
                     # invalidate cache if file was modified and present in cache
-                    if partial in lru_file_cache:
-                        del lru_file_cache[partial]
-                        os.remove(os.path.join(gitfs_dir, 'datadir', partial))
+                    invalidate_cached_file(gitfs_dir, partial, branchname)
 
-                nested_set(dir_structure, all_paths, int(filesize))
-                remote_file_size += int(filesize)
+                path_index.add_file(partial, filesize, mtime, mode)
+                if chunks:
+                    chunk_counts[partial] = chunks
+                else:
+                    chunk_counts.pop(partial, None)
+                remote_file_size += filesize
+
+        output = subprocess.run(
+            f'git commit -a -m "merge conflict"',
+            cwd=puredir,
+            capture_output=True,
+            shell=True)
+        logging.debug(output)
 
-    output = subprocess.run(
-        f'git commit -a -m "merge conflict"',
-        cwd=puredir,
-        capture_output=True,
-        shell=True)
-    logging.debug(output)
     output = subprocess.run(
         f'git push -u origin master',
         cwd=puredir,
@@ -435,17 +2557,113 @@ def git_sync_filelist(gitfs_dir):
     return True
 
 
+# files that changed remotely since the kernel last cached them, their next open drops the kernel's page cache
+remote_changed = set()
+
+
+def invalidate_cached_file(gitfs_dir, partial, branchname):
+    """
+    Drops a file and its chunks from the local cache, the memory tier and the kernel's page cache after it changed
+    remotely
+    """
+    remote_changed.add(partial)
+    memory_tier.invalidate(partial)
+    if partial in lru_file_cache:
+        del lru_file_cache[partial]
+        os.remove(os.path.join(gitfs_dir, 'datadir', partial))
+    for index in range(chunk_counts.get(partial, 0)):
+        if (branchname, index) in lru_file_cache:
+            os.remove(lru_file_cache.key_path((branchname, index)))
+            del lru_file_cache[(branchname, index)]
+
+
+# files retrieved by each batch when hydrating pinned paths
+HYDRATE_BATCH = 100
+
+
+def load_pins(path, pin=(), unpin=()):
+    """
+    Reads the pin list, one path per line, adds the paths in pin, removes those in unpin, and writes it back if that
+    changed it. Returns the pinned paths.
+    """
+    pins = []
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            pins = [line.strip() for line in f if line.strip()]
+
+    unpin = set(p.strip('/') for p in unpin)
+    updated = [p for p in pins if p not in unpin]
+    for p in pin:
+        if p.strip('/') not in updated:
+            updated.append(p.strip('/'))
+
+    if updated != pins:
+        with open(path + '.tmp', 'w') as f:
+            f.writelines(p + '\n' for p in updated)
+        os.replace(path + '.tmp', path)
+    return updated
+
+
 #####################
 ##
 # FUSE class
 ##
 #####################
 
+# offset of the readdir call being answered by this thread
+readdir_offset = threading.local()
+
+# largest read and write request libfuse 2 negotiates with the kernel, used by --perf-mount
+PERF_MOUNT_IO = 128 * 1024
+
+
+class GitfsFUSE(FUSE):
+    """
+    Hands Passthrough what fusepy does not pass on to Operations:
+
+    - the readdir offset, through readdir_offset, so listings read in several calls resume where the previous call
+      stopped
+    - the keep_cache flag of open, so the kernel keeps its page cache of files that did not change since they were
+      last opened
+    """
+
+    def readdir(self, path, buf, filler, offset, fip):
+        readdir_offset.value = offset
+        return super().readdir(path, buf, filler, offset, fip)
+
+    def open(self, path, fip):
+        result = super().open(path, fip)
+        if result == 0 and self.operations.keep_cache(path.decode(self.encoding)):
+            fip.contents.keep_cache = 1
+        return result
+
+
 class Passthrough(Operations):
     def __init__(self, gitfs_dir):
         self.gitfs_dir = gitfs_dir
         self.data_dir = os.path.join(gitfs_dir, 'datadir')
+        self.chunk_dir = os.path.join(gitfs_dir, 'chunkdir')
         self.actions = defaultdict(set)
+        # fh -> path, for read-only handles of chunked files that are read chunk by chunk
+        self.chunk_handles = {}
+        # path -> StreamProgress, for files being retrieved from remote
+        self.streams = {}
+        # fh -> StreamProgress, for handles opened while their file was being retrieved, so that reads after a failed
+        # retrieval fail too instead of reading the empty lock file
+        self.stream_handles = {}
+        # fh -> dirty version, for handles that made a clean file dirty by opening it for writing
+        self.write_handles = {}
+        # path -> future, for files being prefetched
+        self.prefetching = {}
+        # path -> future, for files renamed onto path whose branch is not renamed yet
+        self.renames = {}
+        # owner and time reported for files that are not cached, and for directories
+        self.uid = os.getuid()
+        self.gid = os.getgid()
+        self.mount_time = time.time()
+        # fh -> [(name, node)], snapshots of directories being listed
+        self.dir_handles = {}
+        self.dir_handle_counter = itertools.count(1)
 
     # Helpers
     # =======
@@ -475,72 +2693,95 @@ class Passthrough(Operations):
 #         full_path = self._full_path(path)
 #         return os.chown(full_path, uid, gid)
 
-    def getattr(self, path, fh=None):
-        full_path = self._full_path(path)
-        logging.debug(f'GETATTR {path} {fh}')
-
-        partial, all_paths = split_path_all(path)
-
-#         logging.debug(f'{all_paths} {dir_structure} {getFromDict(dir_structure, all_paths)}')
-
-        # check whether path exists in dir_struct
+    def _attrs(self, partial, node):
+        """
+        Attributes of a path, from lstat if it is cached, else from path_index without touching the disk. node is
+        what path_index.lookup returned for it.
+        """
         if lru_file_cache.get(partial, None) is not None:
             # if in cache, it exists on filesystem, return accurate lstat
-            logging.debug(f'{lru_file_cache} {full_path}')
-            st = os.lstat(full_path)
+            st = os.lstat(self._full_path(partial))
             logging.debug(f'present in lru {st}')
-            return dict((key, getattr(st, key)) for key in ('st_atime', 'st_ctime',
-                                                            'st_gid', 'st_mode', 'st_mtime', 'st_nlink', 'st_size', 'st_uid'))  # , 'st_blocks'
-        elif getFromDict(dir_structure, all_paths) is not None:
-            # else if in dir_structure, report accurate size but weird date for label
-            logging.debug('present in dir_structure')
-            if os.path.exists(
-                    full_path):  # if in directory, check if on filesystem
-                st = os.lstat(full_path)
-                logging.debug(str(st))
-                return dict((key, getattr(st, key)) for key in ('st_atime', 'st_ctime',
-                                                                'st_gid', 'st_mode', 'st_mtime', 'st_nlink', 'st_size', 'st_uid'))
-            else:
-                if isinstance(getFromDict(dir_structure, all_paths), dict):
-                    logging.debug('mirage directory')
-                    st_mode = 16893
-                    st_size = 4096
-                    st_nlink = 2
-                else:
-                    logging.debug('mirage file')
-                    st_mode = 33204
-                    st_size = 0
-                    st_nlink = 1
-                logging.debug(str({'st_mode': st_mode, 'st_uid': 1001, 'st_nlink': st_nlink,
-                                   'st_gid': 1001, 'st_size': st_size, 'st_atime': 7226582400, 'st_mtime': 7226582400, 'st_ctime': 7226582400}))
-                # if file/dir doesn't exist locally, report year 2199 for them
-                return {'st_mode': st_mode, 'st_uid': 1001, 'st_nlink': st_nlink,
-                        'st_gid': 1001, 'st_size': st_size, 'st_atime': 7226582400, 'st_mtime': 7226582400, 'st_ctime': 7226582400}
+            attrs = dict((key, getattr(st, key)) for key in ('st_atime', 'st_ctime',
+                                                             'st_gid', 'st_mode', 'st_mtime', 'st_nlink', 'st_size', 'st_uid'))  # , 'st_blocks'
+            if node is not None:
+                attrs['st_ino'] = path_index.attrs(node)[0]
+            return attrs
+
+        ino, mode, size, mtime = path_index.attrs(node)
+        if type(node) is Node:
+            st_mode = 16893
+            st_size = 4096
+            st_nlink = 2
+            st_time = self.mount_time
+        else:
+            st_mode = mode or 33204
+            st_size = size
+            st_nlink = 1
+            progress = self.streams.get(partial, None)
+            if progress is not None and progress.size is not None:
+                # still streaming in, report the full size so the kernel does not cut reads short
+                st_size = progress.size
+            # files uploaded before mtimes were recorded report the mount time
+            st_time = mtime / 1e9 if mtime else self.mount_time
+        return {'st_mode': st_mode, 'st_ino': ino, 'st_uid': self.uid, 'st_nlink': st_nlink,
+                'st_gid': self.gid, 'st_size': st_size, 'st_atime': st_time, 'st_mtime': st_time, 'st_ctime': st_time}
+
+    def getattr(self, path, fh=None):
+        logging.debug(f'GETATTR {path} {fh}')
+
+        partial = path[1:]
+        node = path_index.lookup(path)
 
+        if node is not None or lru_file_cache.get(partial, None) is not None:
+            return self._attrs(partial, node)
+        elif not index_ready.is_set():
+            # may not be loaded yet
+            index_ready.wait()
+            return self.getattr(path, fh)
         else:
             raise FuseOSError(ENOENT)
 
-    def readdir(self, path, fh):
-        dirents = set(['.', '..'])
-        # this needs to go through .git, and also show which are cached
-        # or rather, go through dir_structure  in memory
-        partial, all_paths = split_path_all(path)
-        dir_listing = getFromDict(dir_structure, all_paths)
-
-        if dir_listing is None:
+    def opendir(self, path):
+        """
+        Takes a snapshot of the directory's entries, so that a listing read in several calls neither skips nor
+        repeats entries when the directory changes in between
+        """
+        fh = next(self.dir_handle_counter)
+        self.dir_handles[fh] = self._dir_entries(path)
+        return fh
+
+    def _dir_entries(self, path):
+        index_ready.wait()
+        node = path_index.get(path)
+        if node is None or not node.is_dir():
             raise FuseOSError(ENOENT)
-        if isinstance(dir_listing, dict):
-            dirents.update(dir_listing.keys())
 
-        # also add empty directories present in dir_structure
-        dir_listing = getFromDict(dir_structure, all_paths)
-        if isinstance(dir_listing, dict):
-            dirents.update(dir_listing.keys())
+        # children as they are stored, rows for files, so listing makes no views
+        entries = [('.', node), ('..', node.parent or node)]
+        entries.extend(node.children.items())
+        return entries
+
+    def readdir(self, path, fh):
+        """
+        Yields (name, attrs, offset) of the entries from the offset the kernel asked for, so a large directory is
+        listed in one pass over path_index instead of a getattr call per entry. libfuse only passes inode number and
+        file type on to the kernel, so attrs are just those, from path_index without touching the disk.
+        """
+        entries = self.dir_handles.get(fh, None) or self._dir_entries(path)
+
+        offset = getattr(readdir_offset, 'value', 0)
+        logging.debug(f'READ DIR {path} from {offset} of {len(entries)}')
 
-        logging.debug(f'READ DIR {path} with {dirents}')
+        for index in range(offset, len(entries)):
+            name, node = entries[index]
+            ino, mode, _, _ = path_index.attrs(node)
+            st_mode = 16893 if type(node) is Node else mode or 33204
+            yield name, {'st_ino': ino, 'st_mode': st_mode}, index + 1
 
-        for r in dirents:
-            yield r
+    def releasedir(self, path, fh):
+        self.dir_handles.pop(fh, None)
+        return 0
 
 # symbolic path thingy
 #     def readlink(self, path):
@@ -559,17 +2800,18 @@ class Passthrough(Operations):
         Only called for empty directories
 
         """
+        index_ready.wait()
         full_path = self._full_path(path)
 
         logging.debug(f'RMDIR {path} {full_path}')
 
-        # remove directory from dir_structure
-        partial, all_paths = split_path_all(path)
-        deleteFromDict(dir_structure, all_paths, delete_empty_recursive=False)
+        # remove directory from path_index
+        path_index.remove(path)
 
         return os.rmdir(full_path)
 
     def mkdir(self, path, mode):
+        index_ready.wait()
         full_path = self._full_path(path)
         logging.debug(f'MKDIR {path} {full_path}')
 
@@ -577,9 +2819,8 @@ class Passthrough(Operations):
             os.mkdir(full_path, mode)
 
         # update internal listing (only if os.mkdir succeeds)
-        partial, all_paths = split_path_all(path)
         # not added to LRU because LRU will evict
-        nested_set(dir_structure, all_paths, {})
+        path_index.add_dir(path)
 
         return None
 
@@ -591,38 +2832,39 @@ class Passthrough(Operations):
 #             'f_frsize', 'f_namemax'))
 
     def unlink(self, path):
+        index_ready.wait()
         logging.debug(f'UNLINK {path}')
 
         # for hidden files (.swp / mode 33152 / file~)
-        # they won't be present in lru_file_cache or dir_structure
+        # they won't be present in lru_file_cache or path_index
         # so let os delete (if path exists)
 
-        partial, all_paths = split_path_all(path)
+        partial, _ = split_path_all(path)
 
         logging.debug(f'{lru_file_cache}')
 
+        memory_tier.invalidate(partial)
+        self._drop_chunks(partial)
+        chunk_counts.pop(partial, None)
+        # no point uploading it anymore
+        commit_batcher.discard(partial)
+
         if lru_file_cache.get(partial, None) is not None:
             logging.debug('lru delete')
             # delete from lru
             del lru_file_cache[partial]
-            # delete from dir_structure
-            deleteFromDict(
-                dir_structure,
-                all_paths,
-                delete_empty_recursive=False)
+            # delete from path_index
+            path_index.remove(partial)
             # remove from remote
             self.remove_from_remote(path, block=False)
 
             # actually delete from FS
             return os.unlink(self._full_path(path))
 
-        elif getFromDict(dir_structure, all_paths) is not None:
+        elif path_index.get(partial) is not None:
             logging.debug('dir delete')
-            # delete from dir_structure
-            deleteFromDict(
-                dir_structure,
-                all_paths,
-                delete_empty_recursive=False)
+            # delete from path_index
+            path_index.remove(partial)
             # remove from remote
             self.remove_from_remote(path, block=False)
 
@@ -657,118 +2899,59 @@ class Passthrough(Operations):
         - Check if destination is file and already exists:
             - If yes, delete destination file
         - Check if source is directory and contains files:
-            - If yes, rename every file within recursively
+            - If yes, rename every file within recursively, found through path_index as most may not be cached
               (Unfortunately, there doesn't seem to be a way to ask for user input to confirm move of potentially many files)
 
         """
+        index_ready.wait()
         logging.debug(f'RENAME {old_path} {new_path}')
 
-        partial_old, all_paths_old = split_path_all(old_path)
-        partial_new, all_paths_new = split_path_all(new_path)
-
-        logging.debug(f'{dir_structure}')
-
-        destination_file_exists = False
-        if self._isfile(all_paths_old):
-            if getFromDict(dir_structure, all_paths_old) is not None:
-                if self._isfile(all_paths_new):
-                    destination_file_exists = True
-
-        os.rename(self._full_path(old_path), self._full_path(new_path))
-        # do os.rename first and only update internal listings if succeed
-
-        if self._isfile(all_paths_old):
-            # updating branch for renaming files
-
-            # update dir_structure
-            nested_set(
-                dir_structure,
-                all_paths_new,
-                getFromDict(
-                    dir_structure,
-                    all_paths_old))
-            deleteFromDict(dir_structure, all_paths_old)
-            # update LRU if present
-            if lru_file_cache.get(partial_old, None) is not None:
-                lru_file_cache[partial_new] = lru_file_cache.get(
-                    partial_old, None)
-                del lru_file_cache[partial_old]
-
-            self.rename_branch(
-                partial_old,
-                partial_new,
-                destination_file_exists)
-
-        else:
+        partial_old, _ = split_path_all(old_path)
+        partial_new, _ = split_path_all(new_path)
+        memory_tier.invalidate(partial_old)
+        memory_tier.invalidate(partial_new)
+
+        node = path_index.get(partial_old)
+        if node is None:
+            # hidden files are only on the local filesystem
+            return os.rename(self._full_path(old_path), self._full_path(new_path))
+
+        destination = path_index.get(partial_new)
+        if node.is_dir() and destination is not None and destination.is_dir() and destination.children:
+            # as os.rename would, for directories that are not on the local filesystem
+            raise FuseOSError(ENOTEMPTY)
+
+        full_path_old = self._full_path(old_path)
+        full_path_new = self._full_path(new_path)
+        if os.path.lexists(full_path_old):
+            os.makedirs(os.path.dirname(full_path_new), exist_ok=True)
+            os.rename(full_path_old, full_path_new)
+            # do os.rename first and only update internal listings if succeed
+        elif self._isfile(partial_new):
+            # the overwritten file's cached copy is not replaced by one of the source
+            self._drop_cached(partial_new)
+
+        if node.is_dir():
             # updating branch for renaming directories
-            # this transfers each individual file
-            # does not retain empty directories
-
             # since we are storing hashed filepaths as references, we need to
-            # autodetect nested files and rename them all
-
-            for root, dirs, files in os.walk(self._full_path(new_path)):
-                root = root.replace(self._full_path(new_path), '')
-                partial, all_paths = split_path_all(root)
-
-                if files:
-                    for file in files:
-
-#                         logging.debug(f'{partial_old} | {partial_new} |{partial} | {file} | {all_paths}')
-
-                        partial_old_internal = os.path.join(
-                            partial_old, partial, file)
-                        partial_new_internal = os.path.join(
-                            partial_new, partial, file)
-                        all_paths_old_internal = all_paths_old + \
-                            all_paths + [file]
-                        all_paths_new_internal = all_paths_new + \
-                            all_paths + [file]
-
-#                         logging.debug(f'{partial_old_internal}, {partial_new_internal}, {all_paths_old_internal}, {all_paths_new_internal}')
-
-#                         logging.debug(f'{dir_structure}')
-                        # update dir_structure
-                        nested_set(
-                            dir_structure, all_paths_new_internal, getFromDict(
-                                dir_structure, all_paths_old_internal))
-                        deleteFromDict(
-                            dir_structure,
-                            all_paths_old_internal,
-                            delete_empty_recursive=True)
-                        logging.debug(f'{dir_structure}')
-
-#                         logging.debug(f'{lru_file_cache}')
-                        # update LRU if present
-                        if lru_file_cache.get(
-                                partial_old_internal, None) is not None:
-                            lru_file_cache[partial_new_internal] = lru_file_cache.get(
-                                partial_old_internal, None)
-                            del lru_file_cache[partial_old_internal]
-                        logging.debug(f'{lru_file_cache}')
-
-                        self.rename_branch(
-                            partial_old_internal,
-                            partial_new_internal,
-                            destination_file_exists=False)
-
-                else:
-
-                    all_paths_old_internal = all_paths_old + all_paths
-                    all_paths_new = all_paths
+            # rename every file below it, cached or not
+            moves = [(path, partial_new + path[len(partial_old):])
+                     for path, _ in path_index.walk_files(node)]
+        else:
+            # the overwritten file's branch is replaced
+            moves = [(partial_old, partial_new)]
+            self._drop_chunks(partial_new)
 
-                    logging.debug(f'{all_paths_old_internal}')
+        # update path_index, empty directories move along
+        path_index.move(partial_old, partial_new)
 
-                    # dir_struture may not contain directories? (To think about
-                    # it)
-                    if getFromDict(dir_structure,
-                                   all_paths_old_internal) is not None:
-                        nested_set(
-                            dir_structure, all_paths_new, getFromDict(
-                                dir_structure, all_paths_old_internal))
-                        deleteFromDict(dir_structure, all_paths_old_internal)
+        # before uploads of unpushed files under their new names are queued, which wait for it
+        self.rename_branches(moves)
 
-                   # LRU does not have directories
+        for path_old, path_new in moves:
+            memory_tier.invalidate(path_old)
+            self._rename_cached(path_old, path_new)
+            self._rename_chunks(path_old, path_new)
 
         return None
 
@@ -784,37 +2967,97 @@ class Passthrough(Operations):
     # ==================================================================
     # ==================================================================
 
-    def _isfile(self, all_paths):
-        if isinstance(getFromDict(dir_structure, all_paths), dict):
-            return False
-        elif isinstance(getFromDict(dir_structure, all_paths), int):
-            return True
+    def _isfile(self, partial):
+        node = path_index.get(partial)
+        return node is not None and not node.is_dir()
+
+    def _rename_cached(self, partial_old, partial_new):
+        """
+        Moves a file's LRU entry, and its upload if it was not pushed yet
+        """
+        if lru_file_cache.get(partial_old, None) is None:
+            return
+        dirty = lru_file_cache.dirty.get(partial_old) is not None
+        lru_file_cache[partial_new] = lru_file_cache.get(partial_old, None)
+        del lru_file_cache[partial_old]
+        if dirty:
+            # upload it under its new name instead, after the branch is renamed
+            commit_batcher.discard(partial_old)
+            self.commit_to_remote(partial_new)
+
+    def _drop_cached(self, partial):
+        """
+        Removes a file's cached copy and its pending upload
+        """
+        commit_batcher.discard(partial)
+        if lru_file_cache.get(partial, None) is not None:
+            del lru_file_cache[partial]
+            os.remove(self._full_path(partial))
+
+    def _drop_chunks(self, partial):
+        """
+        Removes cached chunks of a chunked file, they are stale once the file is rewritten, renamed or deleted
+        """
+        path_hash = branch_name(partial)
+        for index in range(chunk_counts.get(partial, 0)):
+            if (path_hash, index) in lru_file_cache:
+                del lru_file_cache[(path_hash, index)]
+                os.remove(lru_file_cache.key_path((path_hash, index)))
+
+    def _rename_chunks(self, partial_old, partial_new):
+        # cached chunks are keyed by branch name, which changes with the path
+        self._drop_chunks(partial_old)
+        if partial_old in chunk_counts:
+            chunk_counts[partial_new] = chunk_counts.pop(partial_old)
         else:
-            raise ValueError(
-                f'_isfile returned neither true nor false {dir_structure} {all_paths} {getFromDict(dir_structure, all_paths)}')
+            # a chunked file it replaced is gone
+            chunk_counts.pop(partial_new, None)
 
-    def rename_branch(self, path_old, path_new, destination_file_exists):
+    def rename_branches(self, moves):
         """
         The way we set things up, since we hash the path to get branch name, we have to delete branch
 
+        Renames of all files in moves are done by one job. Uploads to the new paths wait until it is done, so a
+        file saved under its new name is not replaced by the renamed branch.
         Refer to: https://stackoverflow.com/a/21302474
         """
-        if path_old.startswith("/"):
-            path_old = path_old[1:]
+        if moves:
+            paths = [path_new for _, path_new in moves]
+            commit_batcher.hold(paths)
+            future = self._after_uploads(
+                [path_old for path_old, _ in moves], git_rename_branches, self.gitfs_dir, moves)
+            for path in paths:
+                self.renames[path] = future
+            future.add_done_callback(lambda f: self._renamed(paths, f))
+
+        return True
 
-        if path_new.startswith("/"):
-            path_new = path_new[1:]
+    def _renamed(self, paths, future):
+        commit_batcher.unhold(paths)
+        for path in paths:
+            if self.renames.get(path, None) is future:
+                del self.renames[path]
 
+    def _after_rename(self, path, submit):
+        """
+        Returns submit(), or if a file was renamed onto path and its branch is not renamed yet, a future resolved as
+        the one submit() returns once the branch is. Retrievals go through this, the file is not on remote under its
+        new name before.
+        """
+        rename = self.renames.get(path, None)
+        if rename is None or rename.done():
+            return submit()
 
-        executor.submit(
-            git_rename_branch,
-            self.gitfs_dir,
-            path_old,
-            path_new,
-            destination_file_exists,
-            self.remove_from_remote)
+        future = Future()
 
-        return True
+        def start(_):
+            if not future.set_running_or_notify_cancel():
+                # nobody waits for it anymore
+                return
+            submit().add_done_callback(lambda f: copy_future(f, future))
+
+        rename.add_done_callback(start)
+        return future
 
     def remove_from_remote(self, path, block=False):
         logging.debug(f'REMOVING FROM REMOTE {path}')
@@ -822,38 +3065,35 @@ class Passthrough(Operations):
         if path.startswith("/"):
             path = path[1:]
 
-        path_hash = hashlib.sha1(bytes(path, 'utf-8')).hexdigest()[:-1]
+        path_hash = branch_name(path)
 
         partial = path
         if partial.startswith("/"):
             partial = partial[1:]
 
+        future = self._after_uploads([partial], git_remove_from_remote, self.gitfs_dir, path_hash)
         if block:
-            # used in git_rename_branch
-            executor.submit(
-                git_remove_from_remote,
-                self.gitfs_dir,
-                path_hash).result()
-        else:
-            executor.submit(
-                git_remove_from_remote,
-                self.gitfs_dir,
-                path_hash)
+            future.result()
 
         return True
 
-    def retrieve_from_remote(self, path, full_path):
-
-        logging.debug(f'RETRIEVING FROM REMOTE {path} {full_path}')
+    def _after_uploads(self, paths, fn, *args):
+        """
+        Submits fn(*args) as a PRIORITY_MODIFY job once no upload of paths is running, so that it sees their filelist
+        entries and is not undone by them. Returns a future resolved as the job's.
+        """
+        future = Future()
 
-        if path.startswith("/"):
-            path = path[1:]
+        def submit():
+            future.set_running_or_notify_cancel()
+            executor.submit(fn, *args, priority=PRIORITY_MODIFY).add_done_callback(lambda f: copy_future(f, future))
 
-        path_hash = hashlib.sha1(bytes(path, 'utf-8')).hexdigest()[:-1]
+        commit_batcher.after_uploads(paths, submit)
+        return future
 
+    def _prepare_retrieval(self, full_path):
         # create preceding directories if neccessary
         partial, all_paths = split_path_all(full_path)
-        _, path_file = os.path.split(path)
         dir_traversal = ''
 
         for i in all_paths[:-1]:  # assume last element is a file
@@ -862,74 +3102,311 @@ class Passthrough(Operations):
                 os.mkdir(dir_traversal)
 
         # create lock file so no one else touches the file while we do our slow work here
-        # this is for external interference, this function is wrapped by retrieve_queue
+        # this is for external interference, retrievals from within are single-flight
         open(full_path, 'a').close()
         logging.debug(f'created lock file {full_path}')
 
-        # async call, but we want to block using .result()
-        executor.submit(
-            git_retrieve_from_remote,
-            self.gitfs_dir,
-            path_hash,
-            path_file,
-            full_path).result()
+    def retrieve_from_remote(self, path, full_path, wait=True,
+                             priority=PRIORITY_RETRIEVE):
+        """
+        Retrieves a file into full_path. Only one retrieval per file is in flight, later callers join it.
+
+        With wait=False, returns the StreamProgress of the retrieval as soon as it was started. It is also in
+        self.streams until it is done, so reads can wait for just the range they need.
+        """
+
+        if path.startswith("/"):
+            path = path[1:]
+
+        def submit():
+            logging.debug(f'RETRIEVING FROM REMOTE {path} {full_path}')
+            lru_file_cache.record_miss(path)
 
-        # add to LRU!
-        self._add_file_to_fs(path, create=False)
+            node = path_index.get(path)
+            path_hash = branch_name(path)
+            _, path_file = os.path.split(path)
+
+            self._prepare_retrieval(full_path)
+
+            progress = StreamProgress(node.size if node is not None else None)
+            self.streams[path] = progress
+
+            future = self._after_rename(path, lambda: executor.submit(
+                git_retrieve_from_remote,
+                self.gitfs_dir,
+                path_hash,
+                path_file,
+                full_path,
+                chunks=chunk_counts.get(path, 0),
+                progress=progress,
+                priority=priority))
+            future.progress = progress
+            future.add_done_callback(lambda f: self._retrieved(path, full_path, progress, f))
+            return future
+
+        if not wait:
+            return retrieval.start(path, submit).progress
+
+        try:
+            retrieval.wait(path, submit, timeout=retrieve_timeout or None)
+        except FuturesTimeoutError:
+            logging.error(f'timed out retrieving {path}')
+            raise FuseOSError(ETIMEDOUT)
+        except Exception:
+            logging.exception(f'retrieving {path} failed')
+            raise FuseOSError(EIO)
 
         return True
 
+    def init(self, path):
+        if hydrate:
+            threading.Thread(
+                target=self.hydrate,
+                args=(lru_file_cache.pins,),
+                name='hydrator',
+                daemon=True).start()
+
+    def hydrate(self, pins):
+        """
+        Retrieves every file at or below the pinned paths that is not cached, as far as they fit in the pin budget, in
+        batches of HYDRATE_BATCH files that run in parallel. Progress is logged as batches finish.
+        """
+        index_ready.wait()
+
+        files = []
+        for pin in sorted(pins):
+            node = path_index.get(pin)
+            if node is None:
+                logging.error(f'pinned path {pin} does not exist')
+            elif node.is_dir():
+                files.extend(path_index.walk_files(node))
+            else:
+                files.append((pin, node))
+
+        budget = lru_file_cache.pin_size - lru_file_cache.pinned_size
+        missing = []
+        for path, node in files:
+            if lru_file_cache.get(path, None) is not None:
+                continue
+            if node.size > budget:
+                logging.warning(f'pinned files do not fit in the pin budget, not hydrating {path} and after')
+                break
+            budget -= node.size
+            missing.append((path, node.size))
+
+        total_size = sum(size for _, size in missing)
+        logging.info(f'hydrating {len(missing)} files, {total_size / 1e6:.0f} MB')
+
+        lock = threading.Lock()
+        hydrated = [0, 0]  # files, bytes
+
+        def done(batch, future):
+            with lock:
+                hydrated[0] += len(batch)
+                hydrated[1] += sum(size for _, size in batch)
+                logging.info(f'hydrated {hydrated[0]}/{len(missing)} files, '
+                             f'{hydrated[1] / 1e6:.0f}/{total_size / 1e6:.0f} MB')
+
+        for start in range(0, len(missing), HYDRATE_BATCH):
+            batch = missing[start:start + HYDRATE_BATCH]
+            self._retrieve_batch([path for path, _ in batch]).add_done_callback(
+                lambda future, batch=batch: done(batch, future))
+
+    def _retrieve_batch(self, paths, priority=PRIORITY_PREFETCH):
+        """
+        Retrieves files in the background with one batched fetch, opens of them join the retrieval. Returns the future
+        of the batch.
+        """
+        items = []
+        for path in paths:
+            if path in self.renames:
+                # not on remote under this name yet, it is retrieved once it is opened
+                continue
+            full_path = self._full_path(path)
+
+            def submit(path=path, full_path=full_path):
+                node = path_index.get(path)
+                self._prepare_retrieval(full_path)
+
+                progress = StreamProgress(node.size if node is not None else None)
+                self.streams[path] = progress
+
+                future = Future()
+                future.progress = progress
+                future.add_done_callback(lambda f: self._retrieved(path, full_path, progress, f))
+                self.prefetching[path] = future
+                items.append((branch_name(path), os.path.split(path)[1], chunk_counts.get(path, 0), full_path, progress,
+                              future))
+                return future
+
+            retrieval.start(path, submit)
+
+        return executor.submit(
+            git_retrieve_batch_from_remote,
+            self.gitfs_dir,
+            items,
+            priority=priority)
+
+    def _retrieved(self, path, full_path, progress, future):
+        if future.cancelled() or future.exception() is not None:
+            # readers of a stream waiting for bytes that will never come
+            progress.finish(future.exception() if not future.cancelled() else CancelledError())
+            if os.path.exists(full_path) and lru_file_cache.get(path, None) is None:
+                os.remove(full_path)
+        else:
+            # add to LRU!
+            self._add_file_to_fs(path, create=False)
+            memory_tier.invalidate(path)
+        self.streams.pop(path, None)
+        self.prefetching.pop(path, None)
+
+    def retrieve_chunk(self, path, index):
+        """
+        Returns local path of a chunk of a chunked file, retrieving it if not in cache
+        """
+        path_hash = branch_name(path)
+        key = (path_hash, index)
+        chunk_path = lru_file_cache.key_path(key)
+
+        if lru_file_cache.get(key, None) is not None:
+            lru_file_cache.touch(key)
+            return chunk_path
+
+        def submit():
+            logging.debug(f'RETRIEVING CHUNK FROM REMOTE {path} {index}')
+            lru_file_cache.record_miss(key)
+            future = self._after_rename(path, lambda: executor.submit(
+                git_retrieve_chunk_from_remote,
+                self.gitfs_dir,
+                path_hash,
+                index,
+                chunk_path,
+                priority=PRIORITY_RETRIEVE))
+
+            def done(f):
+                if not f.cancelled() and f.exception() is None:
+                    lru_file_cache[key] = os.lstat(chunk_path).st_size
+            future.add_done_callback(done)
+            return future
+
+        try:
+            retrieval.wait(key, submit, timeout=retrieve_timeout or None)
+        except FuturesTimeoutError:
+            logging.error(f'timed out retrieving {path} chunk {index}')
+            raise FuseOSError(ETIMEDOUT)
+        except Exception:
+            logging.exception(f'retrieving {path} chunk {index} failed')
+            raise FuseOSError(EIO)
+
+        return chunk_path
+
     def commit_to_remote(self, path):
         logging.debug('COMMITING TO REMOTE')
 
         if path.startswith("/"):
             path = path[1:]
 
-        path_hash = hashlib.sha1(bytes(path, 'utf-8')).hexdigest()[:-1]
+        path_hash = branch_name(path)
 
         full_path = self._full_path(path)
         _, filename = os.path.split(path)
 
-        executor.submit(
-            git_commit_to_remote,
-            self.gitfs_dir,
-            path_hash,
-            full_path,
-            filename,
-            path)
+        # new content makes previously cached chunks stale
+        self._drop_chunks(path)
+
+        # keep it on disk until it is pushed
+        lru_file_cache.mark_dirty(path)
+        commit_batcher.add(path, path_hash, full_path, filename)
 
         return True
 
     def open(self, path, flags):
+        index_ready.wait()
         full_path = self._full_path(path)
         logging.debug(f'OPEN {path} {full_path} {flags}')
 
-        # check exists in current retrieval queue so we don't retrieve the same object multiple times
-        if path in retrieve_queue:
-            for i in range(
-                    100):  # 10 second wait for retrieve to complete, else go retrieve again (consider raise error instead?)
-                time.sleep(0.1)
-                if path not in retrieve_queue:
-                    break
+        partial, _ = split_path_all(path)
+        read_only = not flags & (os.O_WRONLY | os.O_RDWR | os.O_TRUNC)
+
+        prefetch = self.prefetching.get(partial, None)
+        if prefetch is not None and prefetch.cancel():
+            # still queued behind other git operations, retrieve it right away instead
+            logging.debug(f'prefetch of {partial} overtaken by open')
+        prefetcher.opened(partial, self._retrieve_batch)
+        if not read_only:
+            memory_tier.invalidate(partial)
+
+        progress = self.streams.get(partial, None)
+        if stream_open and read_only and progress is not None:
+            # already being retrieved, reads wait for the bytes they need
+            fh = os.open(full_path, flags)
+            self.stream_handles[fh] = progress
+            return fh
 
-        partial, all_paths = split_path_all(path)
+        if lru_file_cache.get(partial, None) is not None:
+            lru_file_cache.touch(partial)
+        else:
+            if partial in chunk_counts and read_only:
+                # chunked files opened for reading are fetched chunk by chunk in read()
+                fh = os.open(os.devnull, os.O_RDONLY)
+                self.chunk_handles[fh] = partial
+                return fh
 
-        if lru_file_cache.get(partial, None) is None:
-            if getFromDict(dir_structure, all_paths) is not None:
+            if path_index.get(partial) is not None:
                 # TODO trying to open a directory should give a IsADirectory
                 # error, but does it actually go in here?
-                retrieve_queue.add(path)
-                self.retrieve_from_remote(path, full_path)  # this blocks!
-                retrieve_queue.remove(path)
+                if stream_open and read_only:
+                    # return right away, read() waits for the range it needs
+                    progress = self.retrieve_from_remote(path, full_path, wait=False)
+                    fh = os.open(full_path, flags)
+                    self.stream_handles[fh] = progress
+                    return fh
+
+                # this blocks! joins the retrieval if another open already started it
+                self.retrieve_from_remote(path, full_path)
 
         # if hidden file, won't be found in cache
         # but file will be found by this open
 
         # if file not present, this will show a filenotfound error
 
-        return os.open(full_path, flags)
+        fh = os.open(full_path, flags)
+        if not read_only and path_index.get(partial) is not None:
+            self._opened_for_write(path, fh, flags)
+        return fh
+
+    def _opened_for_write(self, path, fh, flags):
+        """
+        Marks a file opened for writing dirty right away, so it is not evicted before its first write(). O_TRUNC
+        already changed it, so it is uploaded on release even if nothing is written.
+        """
+        partial = path[1:]
+        if partial not in lru_file_cache:
+            # retrieved, but _retrieved may not have added it yet
+            self._add_file_to_fs(path)
+        was_dirty = partial in lru_file_cache.dirty
+        version = lru_file_cache.mark_dirty(partial)
+        if flags & os.O_TRUNC:
+            self.actions[path].add('write')
+        elif not was_dirty:
+            # clean again on release if nothing was written
+            self.write_handles[fh] = version
+
+    def keep_cache(self, path):
+        """
+        Whether the kernel may keep its page cache of a file being opened: only with --perf-mount, for files that are
+        cached and pushed, and did not change remotely since they were last opened
+        """
+        partial = path[1:]
+        if partial in remote_changed:
+            # opening without keep_cache drops the pages cached before the change
+            remote_changed.discard(partial)
+            return False
+        return perf_mount and partial not in self.streams and partial not in lru_file_cache.dirty and \
+            partial in lru_file_cache
 
     def create(self, path, mode, fi=None):
+        index_ready.wait()
         full_path = self._full_path(path)
         logging.debug(f'CREATE {path} {full_path} mode:{mode}')
 
@@ -940,33 +3417,90 @@ class Passthrough(Operations):
             return os.open(full_path, os.O_WRONLY | os.O_CREAT, mode)
 
         self.actions[path].add('write')
-        # seems like need to add the file to LRU / dir_structure at this point,
+        memory_tier.invalidate(path[1:])
+        # seems like need to add the file to LRU / path_index at this point,
         # so ls can work right after!
         self._add_file_to_fs(path, create=True)
+        lru_file_cache.mark_dirty(path[1:])
 
         return os.open(full_path, os.O_WRONLY | os.O_CREAT, mode)
 
     def read(self, path, length, offset, fh):
-        os.lseek(fh, offset, os.SEEK_SET)
         logging.debug(f'READ {path}')
         self.actions[path].add('read')
-        return os.read(fh, length)
+        if fh in self.chunk_handles:
+            return self._read_chunks(self.chunk_handles[fh], length, offset)
+        partial = path[1:]
+        data = memory_tier.get(partial) if memory_tier.maxsize else None
+        if data is not None:
+            # fusepy copies the result with ctypes.memmove, which takes bytes but not a memoryview
+            return bytes(data[offset:offset + length])
+        progress = self.stream_handles.get(fh, None) or self.streams.get(partial, None)
+        if progress is not None:
+            try:
+                progress.wait_for(offset + length, timeout=retrieve_timeout)
+            except FuturesTimeoutError:
+                logging.error(f'timed out streaming {path}')
+                raise FuseOSError(ETIMEDOUT)
+            except Exception:
+                logging.exception(f'streaming {path} failed')
+                raise FuseOSError(EIO)
+        elif memory_tier.maxsize and 'write' not in self.actions[path]:
+            memory_tier.read_from_disk(partial, fh, lru_file_cache.get(partial, None))
+        return os.pread(fh, length, offset)
+
+    def _read_chunks(self, partial, length, offset):
+        """
+        Reads a range of a chunked file, retrieving only the chunks covering it
+        """
+        filesize = path_index.get(partial).size
+        length_per_chunk = chunk_length(filesize, chunk_counts[partial])
+        end = min(offset + length, filesize)
+
+        data = []
+        while offset < end:
+            index = offset // length_per_chunk
+            chunk_offset = offset - index * length_per_chunk
+            size = min(end - offset, length_per_chunk - chunk_offset)
+
+            with open(self.retrieve_chunk(partial, index), 'rb') as f:
+                f.seek(chunk_offset)
+                data.append(f.read(size))
+            offset += size
+
+        return b''.join(data)
 
     def write(self, path, buf, offset, fh):
-        os.lseek(fh, offset, os.SEEK_SET)
+        # don't get further ahead of uploads
+        commit_batcher.throttle()
         logging.debug(f'write {path}')
         self.actions[path].add('write')
-        return os.write(fh, buf)
+        lru_file_cache.mark_dirty(path[1:])
+        memory_tier.invalidate(path[1:])
+        return os.pwrite(fh, buf, offset)
 
     def truncate(self, path, length, fh=None):
         full_path = self._full_path(path)
         logging.debug(f'truncate {path} {full_path}')
+        memory_tier.invalidate(path[1:])
+        lru_file_cache.mark_dirty(path[1:])
         with open(full_path, 'r+') as f:
             f.truncate(length)
 
+        if path_index.get(path[1:]) is None:
+            return
+        if fh is not None:
+            # uploaded on release
+            self.actions[path].add('write')
+        else:
+            self._add_file_to_fs(path)
+            self.commit_to_remote(path)
+
     def flush(self, path, fh):
         # we might need to save here, investigate
         logging.debug(f'FLUSHED {path}')
+        if fh in self.chunk_handles:
+            return None
         return os.fsync(fh)
 
     def release(self, path, fh):
@@ -980,11 +3514,17 @@ class Passthrough(Operations):
         logging.debug(f'FILE CLOSED {path}')
 
         actions = self.actions.pop(path, ())
+        self.chunk_handles.pop(fh, None)
+        self.stream_handles.pop(fh, None)
+        version = self.write_handles.pop(fh, None)
+        if version is not None and 'write' not in actions:
+            lru_file_cache.mark_clean(path[1:], version)
 
         if 'write' in actions:
-            # add the updated file to dir_structure
+            # add the updated file to path_index
             self._add_file_to_fs(path)
             self.commit_to_remote(path)  # not in a hurry for this
+            commit_batcher.throttle()
         elif 'read' in actions:
             pass  # in the future, we might want to check the remote repo for updates on this file?
         return os.close(fh)
@@ -998,21 +3538,90 @@ class Passthrough(Operations):
             size = 0
         else:
             size = os.lstat(self._full_path(path)).st_size
-        partial, all_paths = split_path_all(path)
-        nested_set(dir_structure, all_paths, size)
+        partial, _ = split_path_all(path)
+        path_index.add_file(partial, size)
 
         # and LRU
         lru_file_cache[partial] = size
 
-        logging.debug(dir_structure)
         logging.debug(lru_file_cache)
 
 
-def main(mountpoint, gitfs_dir):
+def load_index(gitfs_dir, manifest_path, pull=False):
+    """
+    Loads the local index, pure/filelist.txt and the cache manifest, into path_index and lru_file_cache, then sets
+    index_ready.
+
+    With pull, runs after mounting: paths show up as they are loaded, and the remote is pulled and reconciled once
+    lookups can be answered.
+    """
     global remote_file_size
 
+    data_dir = os.path.join(gitfs_dir, 'datadir')
+    chunk_dir = os.path.join(gitfs_dir, 'chunkdir')
+
+    try:
+        # Delete all dirty dirs and the object store they share to cleanup
+        for i in glob(os.path.join(gitfs_dir, 'dirty_*')):
+            shutil.rmtree(i)
+        shutil.rmtree(os.path.join(gitfs_dir, 'objects'), ignore_errors=True)
+
+        # populate path_index and remote_file_size
+        filelist.load()
+        for branchname, (filepath, filesize, chunks, mtime, mode, *_) in filelist.items():
+            partial, _ = split_path_all(filepath)
+            path_index.add_file(partial, filesize, mtime, mode)
+            if chunks:
+                chunk_counts[partial] = chunks
+            remote_file_size += filesize
+
+        logging.debug(f'remote_file_size {remote_file_size}')
+
+        # populate lru_file_cache
+        chunked_hashes = set(hashlib.sha1(bytes(partial, 'utf-8')).hexdigest()[:-1]
+                             for partial in chunk_counts)
+
+        def keep(key):
+            # only add to cache if exists in repo!
+            if isinstance(key, tuple):
+                return key[0] in chunked_hashes
+            return path_index.get(key) is not None
+
+        dirty = lru_file_cache.load_manifest(manifest_path, keep)
+        if dirty is None:
+            scan_cache(data_dir, chunk_dir)
+        else:
+            # files that were saved but not pushed before we stopped
+            for partial in dirty:
+                if isinstance(partial, tuple):
+                    continue
+                commit_batcher.add(
+                    partial,
+                    path_index.add_file(partial, lru_file_cache.get(partial)).path_hash,
+                    os.path.join(data_dir, partial),
+                    os.path.split(partial)[1])
+
+            # the manifest can be behind the disk, e.g. after a crash
+            threading.Thread(
+                target=scan_cache,
+                args=(data_dir, chunk_dir, True),
+                name='cache_check',
+                daemon=True).start()
+
+    finally:
+        # never leave lookups waiting
+        index_ready.set()
+    logging.info('index loaded')
+
+    if pull:
+        git_sync_filelist(gitfs_dir)
+
+
+def main(mountpoint, gitfs_dir):
     data_dir = os.path.join(gitfs_dir, 'datadir')
     pure_dir = os.path.join(gitfs_dir, 'pure')
+    chunk_dir = os.path.join(gitfs_dir, 'chunkdir')
+    manifest_path = os.path.join(gitfs_dir, 'cache_manifest.txt')
 
     if os.path.exists(gitfs_dir):
         # ensure consistencies
@@ -1020,20 +3629,32 @@ def main(mountpoint, gitfs_dir):
     else:
         os.makedirs(gitfs_dir)
         os.makedirs(data_dir)
-        os.makedirs(pure_dir)
-        open(os.path.join(pure_dir, 'filelist.txt'), 'w').close()
+    os.makedirs(chunk_dir, exist_ok=True)
+    # evicted files that were not deleted yet
+    shutil.rmtree(lru_file_cache.trash_dir, ignore_errors=True)
+    os.makedirs(lru_file_cache.trash_dir)
+
+    pins = load_pins(os.path.join(gitfs_dir, 'pins.txt'), pin, unpin)
+    lru_file_cache.set_pins(pins)
+    logging.info(f'pinned {pins}')
 
     # Check whether pure exists
     # if not, git clone
+    cloned = False
     if not os.path.exists(os.path.join(pure_dir, '.git')):
+        shutil.rmtree(pure_dir, ignore_errors=True)
         output = subprocess.run(
-            f'git clone https://{username}:{token}@{gitrepo}',
-            cwd=pure_dir,
+            f'git clone https://{username}:{token}@{gitrepo} pure',
+            cwd=gitfs_dir,
             capture_output=True,
             shell=True)
+        logging.debug(output)
 
-        if b"fatal: repository" in output.stdout and b"not found" in output.stdout:
+        if b"fatal: repository" in output.stderr and b"not found" in output.stderr:
             raise ValueError('Repo not found, please go to git repo website to create repo')
+        # a new repo has no filelist yet
+        open(os.path.join(pure_dir, 'filelist.txt'), 'a').close()
+        cloned = True
 
     # if yes, git pull
     # pure should always be in master, so don't bother check out master, just pull
@@ -1043,62 +3664,106 @@ def main(mountpoint, gitfs_dir):
         capture_output=True,
         shell=True)
 
-    output = subprocess.run(
-        f"git pull https://{username}:{token}@{gitrepo}",
-        cwd=pure_dir,
-        capture_output=True,
-        shell=True)
-    logging.debug(output)
+    if fast_start and not cloned:
+        # mount from the local index right away, pull while it is being used
+        threading.Thread(
+            target=load_index,
+            args=(gitfs_dir, manifest_path, True),
+            name='index_loader',
+            daemon=True).start()
+    else:
+        output = subprocess.run(
+            f"git pull https://{username}:{token}@{gitrepo}",
+            cwd=pure_dir,
+            capture_output=True,
+            shell=True)
+        logging.debug(output)
 
-    # Delete all fsworker dirs to cleanup
-    for i in glob(os.path.join(gitfs_dir, 'fsworker*')):
-        shutil.rmtree(i)
+        load_index(gitfs_dir, manifest_path)
 
-    # populate dir_structure and remote_file_size
-    with open(os.path.join(pure_dir, 'filelist.txt'), 'r') as csvfile:
-        f = csv.reader(csvfile, delimiter=' ', quotechar='|')
-        for filepath, branchname, filesize in f:
-            partial, all_paths = split_path_all(filepath)
-            # do this way because helps in directory commands like ls
-            nested_set(dir_structure, all_paths, int(filesize))
-            remote_file_size += int(filesize)
+    logging.debug(f'lru_file_cache {lru_file_cache}')
 
-        logging.debug(f'remote_file_size {remote_file_size}')
+    io_options = {}
+    if perf_mount:
+        io_options = dict(big_writes=True, max_read=PERF_MOUNT_IO, max_write=PERF_MOUNT_IO,
+                          max_readahead=PERF_MOUNT_IO)
+
+    GitfsFUSE(
+        Passthrough(gitfs_dir),
+        mountpoint,
+        nothreads=False,
+        foreground=True,
+        use_ino=True,
+        attr_timeout=attr_timeout,
+        entry_timeout=attr_timeout,
+        **io_options)
+
+    # let queued uploads finish after unmount
+    commit_batcher.drain()
+    executor.shutdown(wait=True)
+    lru_file_cache.save_manifest(manifest_path)
+
+
+def scan_cache(data_dir, chunk_dir, verify=False):
+    """
+    Adds files in datadir and chunks in chunkdir that exist in the repo to lru_file_cache.
+
+    With verify, first drops entries already in it whose file is gone. This runs in the background after a start from
+    the cache manifest, so it must not add files that are being retrieved.
+    """
+    if verify:
+        for key in list(lru_file_cache):
+            if not os.path.exists(lru_file_cache.key_path(key)):
+                logging.error(f'cached file missing {key}')
+                try:
+                    del lru_file_cache[key]
+                except KeyError:
+                    pass
+
+    def add(key, filesize):
+        with retrieval.lock:
+            if key not in lru_file_cache and not retrieval.in_flight(key):
+                lru_file_cache[key] = filesize
 
-    # populate lru_file_cache
     for root, dirs, files in os.walk(data_dir):
         if files:
             root = root.replace(data_dir, '')
-            partial, all_paths = split_path_all(root)
+            partial, _ = split_path_all(root)
             for file in files:
-                try:
-                    # only add to cache if exists in repo!
-                    filesize = getFromDict(dir_structure, [*all_paths, file])
+                if os.path.join(partial, file) in lru_file_cache:
+                    continue
+                # only add to cache if exists in repo!
+                node = path_index.get(os.path.join(partial, file))
 
-                    if filesize is None:
-                        # TODO offer to retry upload all
-                        # else might want to delete files, or LRU won't hold
-                        # promise
-                        logging.error(
-                            f"orphan file (in local but not remote) {[*all_paths,file]}")
+                if node is None or node.is_dir():
+                    # TODO offer to retry upload all
+                    # else might want to delete files, or LRU won't hold
+                    # promise
+                    logging.error(
+                        f"orphan file (in local but not remote) {os.path.join(partial, file)}")
 
-                        continue
+                    continue
 
-                    lru_file_cache[os.path.join(partial, file)] = int(filesize)
+                add(os.path.join(partial, file), node.size)
 
-#                     logging.debug(f"added {[*all_paths,file]}, size {filesize}")
-                except KeyError:
-                    logging.error(f"file not found {[*all_paths,file]}")
-                    continue
+#                 logging.debug(f"added {os.path.join(partial, file)}, size {node.size}")
 
-    logging.debug(f'dir_structure {dir_structure}')
-    logging.debug(f'dir_structure {lru_file_cache}')
+    # cached chunks
+    chunked_hashes = set(hashlib.sha1(bytes(partial, 'utf-8')).hexdigest()[:-1]
+                         for partial in chunk_counts)
+    for path_hash in os.listdir(chunk_dir):
+        if path_hash not in chunked_hashes:
+            # file was deleted or rewritten, its chunks are stale
+            shutil.rmtree(os.path.join(chunk_dir, path_hash), ignore_errors=True)
+            continue
+        for index in os.listdir(os.path.join(chunk_dir, path_hash)):
+            try:
+                add((path_hash, int(index)), os.lstat(
+                    os.path.join(chunk_dir, path_hash, index)).st_size)
+            except FileNotFoundError:
+                pass
 
-    FUSE(
-        Passthrough(gitfs_dir),
-        mountpoint,
-        nothreads=False,
-        foreground=True)
+    logging.debug(f'scanned cache {lru_file_cache.stats()}')
 
 
 def sync_loop(gitfs_dir, sync_freq):
@@ -1107,6 +3772,16 @@ def sync_loop(gitfs_dir, sync_freq):
         time.sleep(sync_freq * 60)
         logging.debug('syncing filelist.txt')
         git_sync_filelist(gitfs_dir)
+        if stale_members:
+            executor.submit(
+                git_repack_bundles,
+                gitfs_dir,
+                priority=PRIORITY_COMMIT,
+                exclusive=True)
+        logging.info(f'cache {lru_file_cache.stats()}')
+        logging.info(f'memory {memory_tier.stats()}')
+        logging.info(f'prefetch {prefetcher.stats()}')
+        lru_file_cache.save_manifest(os.path.join(gitfs_dir, 'cache_manifest.txt'))
 
 
 if __name__ == '__main__':
@@ -1126,17 +3801,65 @@ All commands except read are done in background and non-blocking."""
                         help='filepath for local mount point')
     parser.add_argument('--cache-size', default=10, type=int,
                         help='cache size on local disk in GB (default=10)')
+    parser.add_argument('--cache-policy', default='lru', choices=CACHE_POLICIES.keys(),
+                        help='replacement policy of the local disk cache, 2q, arc and tinylfu resist scans (default=lru)')
+    parser.add_argument('--cache-low-watermark', default=0.9, type=float,
+                        help='once the cache is full, evict files in the background until it is under this fraction of cache size (default=0.9)')
+    parser.add_argument('--cache-hard-limit', default=1.2, type=float,
+                        help='block adding files to the cache while it is over this fraction of cache size (default=1.2)')
+    parser.add_argument('--pin', action='append', default=[], metavar='PATH',
+                        help='keep the files at or below PATH, relative to the mountpoint, in the cache. Pins are saved, so this is only needed once (repeatable)')
+    parser.add_argument('--unpin', action='append', default=[], metavar='PATH',
+                        help='remove PATH from the saved pins (repeatable)')
+    parser.add_argument('--pin-size', default=10, type=int,
+                        help='local disk storage in GB for pinned files, on top of the cache size (default=10)')
+    parser.add_argument('--hydrate', action='store_true',
+                        help='retrieve all pinned files that are not cached in the background after mounting')
+    parser.add_argument('--memory-cache', default=0, type=int,
+                        help='memory in MB for the contents of small files that are read often (default=0, disabled)')
+    parser.add_argument('--memory-file-size', default=256, type=int,
+                        help='largest file in KB kept in the memory cache (default=256)')
     parser.add_argument('--sync-freq', default=5, type=int,
                         help='sync frequency of file listing in minutes (default=5)')
     parser.add_argument('--workers', default=5, type=int,
                         help='number of threads for git operations (default=5)')
+    parser.add_argument('--retrieve-workers', default=1, type=int,
+                        help='number of git threads reserved for retrieving files on open (default=1)')
+    parser.add_argument('--retrieve-timeout', default=300, type=int,
+                        help='seconds an open, or a read of a file still being streamed in, waits for it to be retrieved before failing, 0 to wait forever (default=300)')
+    parser.add_argument('--chunk-size', default=0, type=int,
+                        help='store files larger than this many MB as chunks of at most this size, which are fetched on demand when read (default=0, disabled)')
+    parser.add_argument('--stream-open', action='store_true',
+                        help='return from open right away and let reads wait only for the part of the file they need while it is retrieved')
+    parser.add_argument('--no-history', action='store_true',
+                        help='keep only the latest version of each file, so saving a file never downloads the previous version and its branch never grows')
+    parser.add_argument('--prefetch', default=0, type=int,
+                        help='when files of a directory are opened in name order, retrieve this many of the next ones in the background (default=0, disabled)')
+    parser.add_argument('--prefetch-cache', default=0.1, type=float,
+                        help='fraction of cache size that prefetched files not opened yet may take (default=0.1)')
+    parser.add_argument('--prefetch-workers', default=1, type=int,
+                        help='number of git threads prefetching may use at once (default=1)')
+    parser.add_argument('--pack-size', default=0, type=int,
+                        help='pack files of at most this many KB into shared bundle branches instead of a branch each (default=0, disabled)')
+    parser.add_argument('--batch-window', default=2, type=float,
+                        help='seconds to collect written files for before uploading them together in one push (default=2)')
+    parser.add_argument('--batch-size', default=100, type=int,
+                        help='upload collected files right away once they add up to this many MB (default=100)')
+    parser.add_argument('--dirty-limit', default=1000, type=int,
+                        help='block writes while more than this many MB of written files wait to be uploaded, 0 to never block (default=1000)')
+    parser.add_argument('--fast-start', action='store_true',
+                        help='mount right away from the local file listing, and pull the remote one in the background')
+    parser.add_argument('--attr-timeout', default=10, type=float,
+                        help='seconds the kernel caches file attributes and lookups for (default=10)')
+    parser.add_argument('--perf-mount', action='store_true',
+                        help='let the kernel keep cached files that did not change in its page cache between opens, and read and write in larger requests')
     parser.add_argument('--git-directory', default='~/.gitfs',
                         help='directory for gitfs operations and cache storage (default=\'~/.gitfs\')')
 
     args = parser.parse_args()
 
     try:
-        git_token = os.environ['gitfs_gittoken']
+        token = os.environ['gitfs_gittoken']
     except KeyError:
         token = input(
             f'Enter git token for {args.username}. Set environment variable \'gitfs_gittoken\' to automate this.\n Token: ')
@@ -1144,36 +3867,96 @@ All commands except read are done in background and non-blocking."""
     username = args.username
     gitrepo = args.gitrepo
     cache_size = args.cache_size
+    pin = args.pin
+    unpin = args.unpin
+    hydrate = args.hydrate
     sync_freq = args.sync_freq
     max_workers = args.workers
+    retrieve_workers = args.retrieve_workers
+    retrieve_timeout = args.retrieve_timeout
+    chunk_size = args.chunk_size
+    stream_open = args.stream_open
+    keep_history = not args.no_history
+    pack_size = args.pack_size
+    # members of bundles no longer referenced since the last repack
+    stale_members = 0
+    batch_window = args.batch_window
+    batch_size = args.batch_size
+    fast_start = args.fast_start
+    attr_timeout = args.attr_timeout
+    perf_mount = args.perf_mount
+    dirty_limit = args.dirty_limit
     gitfs_dir = os.path.expanduser(args.git_directory)
     mount_dir = os.path.expanduser(args.mountpoint)
 
-    lru_file_cache = LRU(
+    lru_file_cache = CACHE_POLICIES[args.cache_policy](
         os.path.join(
             gitfs_dir,
             'datadir'),
-        maxsize=cache_size)
-    # key = filepath
+        maxsize=cache_size,
+        chunk_dir=os.path.join(
+            gitfs_dir,
+            'chunkdir'),
+        low_watermark=args.cache_low_watermark,
+        hard_limit=args.cache_hard_limit,
+        trash_dir=os.path.join(
+            gitfs_dir,
+            'evicting'),
+        pin_size=args.pin_size)
+    # key = filepath, or (branchname, chunk index) for chunks
     # value = filesize
     # LRU strictly for files because it will evict least-used
 
-    dir_structure = {}
-    # {dir_a: {file_a:size, file_b:size, dir_c:{}}
+    memory_tier = MemoryTier(args.memory_cache * 1e6, args.memory_file_size * 1e3)
+    # contents of small files that are read often, above lru_file_cache
+
+    path_index = PathIndex()
+    # files on remote and directories, with their sizes and inode numbers
     # empty dir wiped on restart
 
-    retrieve_queue = set()
+    chunk_counts = {}
+    # key = filepath, value = number of chunks, only for files stored as chunks
+
+    filelist = FileList(os.path.join(gitfs_dir, 'pure'))
+    # files on remote, persisted as pure/filelist.txt + pure/journal.txt
+
+    retrieval = RetrievalCoordinator()
+    # retrievals in flight, so each file is only retrieved once at a time
+
+    prefetcher = Prefetcher(
+        args.prefetch,
+        max_bytes=args.prefetch_cache * cache_size * 1e9,
+        max_batches=args.prefetch_workers)
+    # watches the order files are opened in, and retrieves the next ones of directories being scanned
+
+    index_ready = threading.Event()
+    # set once path_index and lru_file_cache are loaded, lookups of paths not loaded yet wait for it
 
     remote_file_size = 0
 
-    executor = ThreadPoolExecutor(
+    object_store_bytes = 0
+    object_store_generation = 0
+    object_store_reclaiming = False
+    object_store_lock = threading.Lock()
+    # size of objects added to the object store shared by dirty dirs, since it was last reclaimed
+
+    executor = PriorityExecutor(
         max_workers=max_workers,
+        reserved_workers=retrieve_workers,
         thread_name_prefix='fsworker')
     # thread all writes
     # thread all erase
     # block all reads
     # use threads throughout to ensure 1 queue / maximum number of
     # simultaneous connections
+    # reads jump the queue, and have workers reserved for them
+
+    commit_batcher = CommitBatcher(
+        gitfs_dir,
+        window=batch_window,
+        max_bytes=batch_size * 1e6,
+        max_dirty_bytes=dirty_limit * 1e6)
+    # collects written files so they are uploaded together
 
     sync_filelist = threading.Thread(
         target=sync_loop, args=(